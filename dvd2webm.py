@@ -5,10 +5,11 @@
 # Copyright © 2016-2018 R.F. Smith <rsmith@xs4all.nl>.
 # SPDX-License-Identifier: MIT
 # Created: 2016-02-11T19:02:34+01:00
-# Last modified: 2023-03-03T20:34:56+0100
+# Last modified: 2026-10-17T12:00:00+0200
 """
-Convert an mpeg stream from a DVD to a webm file, using constrained rate VP9
-encoding for video and libvorbis for audio.
+Convert an mpeg stream from a DVD to a webm file, using 2-pass VP9 encoding
+for video and libvorbis for audio. By default constrained rate quality is used;
+the --profile option selects another of the VP9 profiles from vidlib.
 
 It uses the first video stream and the first audio stream, unless otherwise
 indicated.
@@ -16,43 +17,51 @@ indicated.
 Optionally it can include a subtitle in the form of an SRT file in the output.
 If the subtitle is a dvdsub track number, it gets overlayed on the video track
 because the webm format only allows webVTT subtitle tracks.
+
+With the --chunks option, the video is split into segments at key frames.
+These segments are encoded concurrently and then joined, after which the audio
+is encoded from the original.
+
+With the --tune option, short trial encodes determine the fastest settings
+that keep the quality. These are remembered per resolution and thread count.
+
+With the --target option, the highest CRF for which some parts of the video
+reach the target SSIM or PSNR is searched, and used in constant quality mode.
 """
 
 from collections import Counter
-from datetime import datetime
+from functools import partial
 import argparse
+import concurrent.futures as cf
 import logging
-import math
 import os
 import re
 import subprocess as sp
 import sys
 
-__version__ = "2022.12.11"
+import vidlib
+
+__version__ = "2026.10.17"
+# The profiles in vidlib that produce webm files.
+PROFILES = [k for k, v in vidlib.PROFILES.items() if v["format"] == "webm"]
 
 
 def main():
     """Entry point for dvd2webm.py."""
     args = setup()
     logging.info(f"processing '{args.fn}'.")
-    starttime = datetime.now()
-    startstr = str(starttime)[:-7]
-    logging.info(f"started at {startstr}.")
     logging.info(f"using audio stream {args.audio}.")
-    tc = 1
+    width = vidlib.probe(args.fn).get("width") or 720
     if not args.crop and args.detect:
         logging.info("looking for cropping.")
         args.crop = findcrop(args.fn)
-        width, height, _, _ = args.crop.split(":")
-        if width in ["720", "704"] and height == "576":
+        cw, ch, _, _ = args.crop.split(":")
+        if cw in ["720", "704"] and ch == "576":
             logging.info("standard format, no cropping necessary.")
             args.crop = None
-            tc = tile_cols(width)
-    else:
-        width, _, _, _ = args.crop.split(":")
-        tc = tile_cols(width)
     if args.crop:
         logging.info("using cropping " + args.crop)
+        width = int(args.crop.split(":")[0])
     subtrack, srtfile = None, None
     if args.subtitle:
         try:
@@ -61,41 +70,60 @@ def main():
         except ValueError:
             srtfile = args.subtitle
             logging.info("using subtitle file " + srtfile)
-    a1 = mkargs(
-        args.fn,
-        1,
-        tc,
-        crop=args.crop,
-        start=args.start,
-        subf=srtfile,
-        subt=subtrack,
-        atrack=args.audio,
-    )
-    a2 = mkargs(
-        args.fn,
-        2,
-        tc,
+    threads = os.cpu_count()
+    tc = vidlib.tile_cols(width, max(1, threads // args.chunks))
+    logging.info(f"using profile {args.profile} with {tc} tile columns")
+    tuning = None
+    if args.tune and args.chunks > 1:
+        logging.warning("--tune cannot be used with --chunks; ignoring it")
+    elif args.tune and not args.dummy:
+        tuning = vidlib.tune(args.fn, args.profile, threads)
+    if args.target and not args.dummy:
+        vf = f"crop={args.crop}" if args.crop else None
+        crf = vidlib.crfsearch(
+            args.fn, args.profile, args.target, args.metric, tuning=tuning, vf=vf
+        )
+        tuning = dict(tuning or {}, **(crf or {}))
+    progress = vidlib.Progress(args.interval, args.metrics)
+    common = dict(
         crop=args.crop,
         start=args.start,
         subf=srtfile,
         subt=subtrack,
         atrack=args.audio,
+        profile=args.profile,
+        tuning=tuning,
     )
-    if not args.dummy:
-        origbytes, newbytes = encode(a1, a2)
-    else:
-        logging.basicConfig(level="INFO")
-        logging.info("first pass: " + " ".join(a1))
-        logging.info("second pass: " + " ".join(a2))
-        return
-    stoptime = datetime.now()
-    stopstr = str(stoptime)[:-7]
-    logging.info(f"ended at {stopstr}.")
-    runtime = stoptime - starttime
-    runstr = str(runtime)[:-7]
-    logging.info(f"total running time {runstr}.")
-    encspeed = origbytes / (runtime.seconds * 1000)
-    logging.info(f"average input encoding speed {encspeed:.2f} kB/s.")
+    passes = [mkargs(args.fn, npass, tc, **common) for npass in (1, 2)]
+    run = None
+    if args.chunks > 1:
+        segmentargs = partial(
+            mkchunkargs,
+            args.fn,
+            tc,
+            args.profile,
+            args.crop,
+            srtfile,
+            subtrack,
+            tuning=tuning,
+        )
+        run = partial(
+            vidlib.encodechunks,
+            args.fn,
+            segmentargs=segmentargs,
+            nchunks=args.chunks,
+            threads=threads,
+            progress=progress,
+            name=args.profile,
+            start=args.start,
+            audio=f"1:a:{args.audio}",
+        )
+    manifest = vidlib.Manifest(args.force)
+    rv = vidlib.convert(args.fn, passes, progress, manifest, dummy=args.dummy, run=run)
+    if rv:
+        logging.error(f"conversion of '{args.fn}' failed, return code {rv}")
+        return 1
+    return 0
 
 
 def setup():
@@ -108,6 +136,12 @@ def setup():
         help="logging level (defaults to 'info')",
     )
     parser.add_argument("-v", "--version", action="version", version=__version__)
+    parser.add_argument(
+        "--profile",
+        default="crq",
+        choices=PROFILES,
+        help="encoding profile (default: crq)",
+    )
     parser.add_argument(
         "-s",
         "--start",
@@ -116,6 +150,39 @@ def setup():
         help="time (hh:mm:ss) at which to start encoding",
     )
     parser.add_argument("-c", "--crop", type=str, help="crop (w:h:x:y) to use")
+    parser.add_argument(
+        "--tune",
+        action="store_true",
+        help="find the fastest encoder settings with trial encodes",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        help="search the highest CRF that reaches this quality score",
+    )
+    parser.add_argument(
+        "--metric",
+        default="ssim",
+        choices=["ssim", "psnr"],
+        help="quality metric for --target (default: ssim)",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="also convert a file that has been converted before",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="seconds between progress reports (default: 10, 0 disables)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="file to append progress reports to as JSON lines",
+    )
     parser.add_argument(
         "-d", "--dummy", action="store_true", help="print commands but do not run them"
     )
@@ -128,6 +195,13 @@ def setup():
         type=str,
         help="srt file or dvdsub track number (default: no subtitle)",
     )
+    parser.add_argument(
+        "-n",
+        "--chunks",
+        type=int,
+        default=1,
+        help="number of segments to encode concurrently (default: 1)",
+    )
     ahelp = "number of the audio track to use (default: 0; first audio track)"
     parser.add_argument("-a", "--audio", type=int, default=0, help=ahelp)
     parser.add_argument("fn", metavar="filename", help="MPEG file to process")
@@ -138,64 +212,66 @@ def setup():
     )
     logging.debug(f"command line arguments = {sys.argv}")
     logging.debug(f"parsed arguments = {args}")
-    if not check_ffmpeg():
+    if not vidlib.check(args.profile):
         sys.exit(1)
     return args
 
 
-def tile_cols(width):
-    return math.floor(math.log2(math.ceil(float(width) / 64.0)))
-
-
-def check_ffmpeg():
-    """Check the minumum version requirement of ffmpeg, and that it is built with
-    the needed drivers enabled."""
-    args = ["ffmpeg", "-version"]
-    try:
-        proc = sp.run(args, text=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
-    except FileNotFoundError:
-        logging.error("ffmpeg not found")
-        return False
-    verre = r"ffmpeg version (\d+)\.(\d+)(?:\.(\d+))? Copyright"
-    major, minor, patch, *rest = re.findall(verre, proc.stdout)[0]
-    logging.info(f"found ffmpeg {major}.{minor}.{patch}")
-    if int(major) < 3 and int(minor) < 3:
-        logging.error(f"ffmpeg 3.3 is required; found {major}.{minor}.{patch}")
-        return False
-    if not re.search(r"enable-libvpx", proc.stdout):
-        logging.error("ffmpeg is not built with VP9 video support.")
-        return False
-    if not re.search(r"enable-libvorbis", proc.stdout):
-        logging.error("ffmpeg is not built with Vorbis audio support.")
-        return False
-    return True
-
-
-def findcrop(path, start="00:10:00", duration="00:00:01"):
+def findcrop(path, points=8, frames=5):
     """
     Find the cropping of the video file.
 
+    Samples are taken at evenly spaced points over the whole video
+    concurrently, and the most common cropping wins.
+
     Arguments:
         path: location of the file to query.
-        start: A string that defines where in the movie to start scanning.
-            Defaults to 10 minutes from the start. Format HH:MM:SS.
-        duration: A string defining how much of the movie to scan. Defaults to
-            one second. Format HH:MM:SS.
+        points: Number of places in the movie to sample. Defaults to 8.
+        frames: Number of key frames to scan per sample. Defaults to 5.
 
     Returns:
         A string containing the cropping to use with ffmpeg.
     """
+    length = vidlib.duration(path)
+    if length:
+        starts = [length * (k + 0.5) / points for k in range(points)]
+    else:
+        starts = [0.0]
+    with cf.ThreadPoolExecutor(max_workers=len(starts)) as tp:
+        samples = tp.map(partial(cropsample, path, frames=frames), starts)
+        rv = Counter(c for sample in samples for c in sample)
+    return rv.most_common(1)[0][0]
+
+
+def cropsample(path, start, frames):
+    """
+    Run the cropdetect filter on part of a video file.
+
+    Only key frames are decoded, which makes this fast.
+
+    Arguments:
+        path: location of the file to query.
+        start: Position in seconds where to start scanning.
+        frames: Number of key frames to scan.
+
+    Returns:
+        A list of cropping strings.
+    """
     args = [
         "ffmpeg",
         "-hide_banner",
+        "-skip_frame",
+        "nokey",  # Only decode key frames.
         "-ss",
-        start,  # Start at 10 minutes in.
-        "-t",
-        duration,  # Parse for one second.
+        f"{start:.3f}",
         "-i",
         path,  # Path to the input file.
+        "-frames:v",
+        str(frames),
         "-vf",
-        "cropdetect",  # Use the crop detect filter.
+        # By default cropdetect ignores the first 2 frames, which would be
+        # most of the few key frames that are decoded here.
+        "cropdetect=skip=0",
         "-an",  # Disable audio output.
         "-y",  # Overwrite output without asking.
         "-f",
@@ -203,27 +279,22 @@ def findcrop(path, start="00:10:00", duration="00:00:01"):
         "/dev/null",  # Write output to /dev/null
     ]
     proc = sp.run(args, universal_newlines=True, stdout=sp.DEVNULL, stderr=sp.PIPE)
-    rv = Counter(re.findall(r"crop=(\d+:\d+:\d+:\d+)", proc.stderr))
-    return rv.most_common(1)[0][0]
-
-
-def reporttime(p, start, end):
-    """
-    Report the amount of time passed between start and end.
-
-    Arguments:
-        p: number of the pass.
-        start: datetime.datetime instance.
-        end: datetime.datetime instance.
-    """
-    dt = str(end - start)[:-7]
-    logging.info(f"pass {p} took {dt}.")
+    return re.findall(r"crop=(\d+:\d+:\d+:\d+)", proc.stderr)
 
 
 def mkargs(
-    fn, npass, tile_columns, crop=None, start=None, subf=None, subt=None, atrack=0
+    fn,
+    npass,
+    tile_columns,
+    crop=None,
+    start=None,
+    subf=None,
+    subt=None,
+    atrack=0,
+    profile="crq",
+    tuning=None,
 ):
-    """Create argument list for constrained quality VP9/vorbis encoding.
+    """Create argument list for VP9/vorbis encoding.
 
     Arguments:
         fn: String containing the path of the input file
@@ -236,6 +307,9 @@ def mkargs(
         subf: Optional string containing the name of the SRT file to use.
         subt: Optional string containing the index of the dvdsub stream to use.
         atrack: Optional number of the audio track to use. Defaults to 0.
+        profile: Name of the profile in vidlib.PROFILES. Defaults to “crq”.
+        tuning: Optional dict of tuned settings from vidlib.tune or
+            vidlib.crfsearch.
 
     Returns:
         A list of strings suitable for calling a subprocess.
@@ -246,8 +320,7 @@ def mkargs(
         raise ValueError("cropping must be in the format W:H:X:Y")
     if start and not re.search(r"\d{2}:\d{2}:\d{2}", start):
         raise ValueError("starting time must be in the format HH:MM:SS")
-    numthreads = str(os.cpu_count())
-    basename = fn.rsplit(".", 1)[0]
+    basename = os.path.splitext(fn)[0]
     args = [
         "ffmpeg",
         "-loglevel",
@@ -260,39 +333,10 @@ def mkargs(
     if start:
         args += ["-ss", start]
     args += ["-i", fn, "-passlogfile", basename]
-    speed = "2"
-    if npass == 1:
-        logging.info(f"using {numthreads} threads")
-        logging.info(f"using {tile_columns} tile columns")
-        speed = "4"
-    args += [
-        "-c:v",
-        "libvpx-vp9",
-        "-row-mt",
-        "1",
-        "-threads",
-        numthreads,
-        "-pass",
-        str(npass),
-        "-b:v",
-        "1400k",
-        "-crf",
-        "33",
-        "-g",
-        "250",
-        "-speed",
-        speed,
-        "-tile-columns",
-        str(tile_columns),
-    ]
-    if npass == 2:
-        args += ["-auto-alt-ref", "1", "-lag-in-frames", "25"]
-    args += ["-sn"]
-    if npass == 1:
-        args += ["-an"]
-    elif npass == 2:
-        args += ["-c:a", "libvorbis", "-q:a", "3"]
-    args += ["-f", "webm"]
+    args += vidlib.encoderargs(
+        profile, npass, os.cpu_count(), tile_columns, tuning=tuning
+    )
+    args += ["-sn", "-f", "webm"]
     if not subt:  # SRT file
         args += ["-map", "0:v", "-map", f"0:a:{atrack}"]
         vf = []
@@ -309,52 +353,92 @@ def mkargs(
         else:
             fc += "[v]"
         args += ["-filter_complex", fc, "-map", "[v]", "-map", f"0:a:{atrack}"]
-    if npass == 1:
-        outname = "/dev/null"
-    else:
-        outname = basename + ".webm"
+    outname = "/dev/null" if npass == 1 else vidlib.outputname(fn, profile)
     args += ["-y", outname]
     return args
 
 
-def encode(args1, args2):
-    """
-    Run the encoding subprocesses.
+def mkchunkargs(
+    fn,
+    tile_columns,
+    profile,
+    crop,
+    subf,
+    subt,
+    npass,
+    start,
+    end,
+    threads,
+    passlog,
+    outname,
+    tuning=None,
+):
+    """Create argument list for VP9 encoding of one segment of the video.
 
     Arguments:
-        args1: Commands to run the first encoding step as a subprocess.
-        args2: Commands to run the second encoding step as a subprocess.
+        fn: String containing the path of the input file
+        tile_columns: number of tile columns.
+        profile: Name of the profile in vidlib.PROFILES.
+        crop: String containing the cropping to use, or None.
+        subf: String containing the name of the SRT file to use, or None.
+        subt: String containing the index of the dvdsub stream to use, or None.
+        npass: Number of the pass. Must be 1 or 2.
+        start: Start of the segment in seconds.
+        end: End of the segment in seconds.
+        threads: Number of threads that the encoder may use.
+        passlog: Prefix for the name of the pass log file.
+        outname: Name of the file for the encoded segment.
+        tuning: Optional dict of tuned settings from vidlib.tune or
+            vidlib.crfsearch.
 
-    Return values:
-        A 2-tuple of the original movie size in bytes and the encoded movie size in bytes.
+    Returns:
+        A list of strings suitable for calling a subprocess.
     """
-    oidx = args2.index("-i") + 1
-    origsize = os.path.getsize(args2[oidx])
-    logging.info("running pass 1...")
-    logging.debug("pass 1: {}".format(" ".join(args1)))
-    start = datetime.utcnow()
-    proc = sp.run(args1, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-    end = datetime.utcnow()
-    if proc.returncode:
-        logging.error(f"pass 1 returned {proc.returncode}.")
-        return origsize, 0
-    else:
-        reporttime(1, start, end)
-    logging.info("running pass 2...")
-    logging.debug("pass 2: {}".format(" ".join(args2)))
-    start = datetime.utcnow()
-    proc = sp.run(args2, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-    end = datetime.utcnow()
-    if proc.returncode:
-        logging.error(f"pass 2 returned {proc.returncode}.")
+    args = [
+        "ffmpeg",
+        "-loglevel",
+        "quiet",
+        "-probesize",
+        "1G",
+        "-analyzeduration",
+        "1G",
+        "-ss",
+        f"{start:.6f}",
+        "-i",
+        fn,
+        "-t",
+        f"{end - start:.6f}",
+        "-passlogfile",
+        passlog,
+    ]
+    args += vidlib.encoderargs(
+        profile, npass, threads, tile_columns, audio=False, tuning=tuning
+    )
+    args += ["-sn", "-f", "webm"]
+    if not subt:  # SRT file
+        args += ["-map", "0:v"]
+        vf = []
+        if subf:
+            # The timestamps of the segment start at 0, those in the SRT file don't.
+            vf = [
+                f"setpts=PTS+{start:.6f}/TB",
+                f"subtitles={subf}",
+                "setpts=PTS-STARTPTS",
+            ]
+        if crop:
+            vf.append(f"crop={crop}")
+        if vf:
+            args += ["-vf", ",".join(vf)]
     else:
-        reporttime(2, start, end)
-    newsize = os.path.getsize(args2[-1])
-    percentage = int(100 * newsize / origsize)
-    ifn, ofn = args2[oidx], args2[-1]
-    logging.info(f"the size of '{ofn}' is {percentage}% of the size of '{ifn}'.")
-    return origsize, newsize  # both in bytes.
+        fc = f"[0:v][0:s:{subt}]overlay"
+        if crop:
+            fc += f",crop={crop}[v]"
+        else:
+            fc += "[v]"
+        args += ["-filter_complex", fc, "-map", "[v]"]
+    args += ["-y", outname if npass == 2 else "/dev/null"]
+    return args
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
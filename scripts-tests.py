@@ -5,7 +5,7 @@
 # Copyright © 2018 R.F. Smith <rsmith@xs4all.nl>.
 # SPDX-License-Identifier: MIT
 # Created: 2015-04-06T13:08:02+0200
-# Last modified: 2019-07-27T15:11:11+0200
+# Last modified: 2026-10-17T12:00:00+0200
 """
 Tests for functions in python files in the scripts directory.
 
@@ -18,6 +18,8 @@ from genotp import rndcaps, otp
 from genpw import roundup, genpw
 from nospaces import fixname
 from offsetsrt import str2ms, ms2str
+import vidlib
+from vidlib import encoderargs, parseprogress, seconds, splitpoints
 
 
 def test_rndcaps():
@@ -65,3 +67,63 @@ def test_srt():
         ts = ms2str(p)
         k = str2ms(ts)
         assert p == k
+
+
+def test_splitpoints():
+    times = [0.0, 2.0, 4.0, 6.0, 8.0, 10.5, 12.0]
+    rv = splitpoints(times, 0.0, 13.0, 4)
+    assert rv == [(0.0, 4.0), (4.0, 6.0), (6.0, 10.5), (10.5, 13.0)]
+    assert splitpoints([0.0], 0.0, 13.0, 4) == [(0.0, 13.0)]
+    assert splitpoints(times, 5.0, 13.0, 2) == [(5.0, 8.0), (8.0, 13.0)]
+
+
+def test_encodechunks_noprobe(monkeypatch):
+    monkeypatch.setattr(vidlib, "probe", lambda fn, keyframes=False: {})
+    rv = vidlib.encodechunks("x.mkv", "x.webm", None, 4, 4, None, "crq", dummy=True)
+    assert rv == 1
+    info = {"duration": 10.0, "keyframes": []}
+    monkeypatch.setattr(vidlib, "probe", lambda fn, keyframes=False: info)
+    rv = vidlib.encodechunks(
+        "x.mkv", "x.webm", None, 4, 4, None, "crq", start="00:00:12", dummy=True
+    )
+    assert rv == 1
+    monkeypatch.setattr(vidlib, "probe", lambda fn, keyframes=False: {"duration": 10.0})
+    calls = []
+    rv = vidlib.encodechunks(
+        "x.mkv",
+        "x.webm",
+        lambda *a: calls.append(a) or [],
+        4,
+        4,
+        None,
+        "crq",
+        dummy=True,
+    )
+    assert rv == 0 and {c[1:3] for c in calls} == {(0.0, 10.0)}
+
+
+def test_parseprogress():
+    lines = ["frame=24\n", "out_time_us=1000000\n", "progress=continue\n"]
+    lines += ["frame=48\n", "speed=1.5x\n", "progress=end\n"]
+    rv = list(parseprogress(lines))
+    assert rv[0] == {"frame": "24", "out_time_us": "1000000", "progress": "continue"}
+    assert rv[1] == {"frame": "48", "speed": "1.5x", "progress": "end"}
+    assert seconds("01:02:03.5") == 3723.5
+    assert seconds("12.25") == 12.25
+
+
+def test_encoderargs():
+    rv = encoderargs("crq", 1, 4, 2)
+    assert rv[-1] == "-an" and rv[rv.index("-threads") + 1] == "4"
+    assert rv[rv.index("-tile-columns") + 1] == "2"
+    rv = encoderargs("bq", 2, 4)
+    assert rv[rv.index("-threads") + 1] == "1" and rv[-2:] == ["-q:a", "3"]
+    tuning = {"-threads": 2, "-speed": 4}
+    rv = encoderargs("crq", 1, 8, 1, tuning=tuning)
+    assert rv[rv.index("-threads") + 1] == "2" and rv[rv.index("-speed") + 1] == "4"
+    rv = encoderargs("con", 2, 8, 1, tuning=tuning)
+    assert rv[rv.index("-threads") + 1] == "2" and rv[rv.index("-speed") + 1] == "4"
+    rv = encoderargs("vod", 1, 8, 1, tuning={"-speed": 1})
+    assert rv[rv.index("-speed") + 1] == "4"
+    rv = encoderargs("mp4", 1, 4, crf=23)
+    assert rv[rv.index("-crf") + 1] == "23" and "medium" in rv and "-an" not in rv
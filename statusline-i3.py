@@ -5,29 +5,84 @@
 # Copyright © 2019 R.F. Smith <rsmith@xs4all.nl>.
 # SPDX-License-Identifier: MIT
 # Created: 2019-06-30T22:23:11+0200
-# Last modified: 2024-06-08T16:17:35+0200
+# Last modified: 2026-10-17T10:12:40+0200
 """
-Generate a status line for i3 on FreeBSD.
+Generate a status line for i3 on FreeBSD or Linux.
 """
 
+from array import array
 import argparse
+import concurrent.futures as cf
 import ctypes
 import ctypes.util
+import errno
+import fnmatch
 import functools as ft
+import glob
+import itertools as it
+import json
 import logging
+import math
 from logging.handlers import SysLogHandler
 import mmap
+import operator as op
 import os
+import re
+import select
+import selectors
+import signal
+import socket
+from stat import S_ISSOCK
 import statistics as stat
 import struct
 import sys
+import threading
 import time
 import traceback
 
 # Global data
-__version__ = "2024.06.08"
+__version__ = "2026.10.17"
 libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
 PAGESIZE = 0
+DUMPSTATS = False
+METRICS = None
+TICK_BUDGET = 1.0
+CTL_MAXNAME = 24
+CPUSTATES = 5
+SPARKS = "▁▂▃▄▅▆▇█"
+# sysctl for the NET_RT_IFLIST routing messages (CTL_NET, PF_ROUTE, 0, 0, NET_RT_IFLIST, 0)
+IFLIST_MIB = (4, 17, 0, 0, 3, 0)
+RTM_IFINFO = 0xE
+# Routing message header: msglen, type.
+RTMSG = struct.Struct("H1xB")
+# struct if_msghdr: ifm_index, ifm_data.ifi_ibytes, ifm_data.ifi_obytes.
+IFMSG = struct.Struct("12xH66xQQ")
+NET_TAU = 3.0
+COLORS = {"warning": "#FFFF00", "urgent": "#FF0000", "stale": "#808080"}
+STALE = " ⌛"
+# Time in seconds that a client of the metrics socket gets for a query.
+QUERY_TIMEOUT = 0.2
+# sysctl for the process table without threads (CTL_KERN, KERN_PROC, KERN_PROC_PROC)
+KERN_PROC_MIB = (1, 14, 8)
+# struct kinfo_proc on amd64: ki_structsize, ki_rssize, ki_pctcpu, ki_flag.
+KINFO = struct.Struct("=i260xq36xI56xq712x")
+P_SYSTEM = 0x200
+KI_COMM = 447
+COMM = struct.Struct("20s")
+FSCALE = 1 << 11
+# struct devstat: device_name, unit_number, device_type.
+DEVSTAT_SIZE = 288
+DEVNAME = struct.Struct("=44x16si196xi24x")
+# Regular expressions for parsing files in /proc on Linux.
+NETDEV = re.compile(rb"^\s*([^:\s]+):\s*(\d+)(?:\s+\d+){7}\s+(\d+)", re.M)
+MEMINFO = re.compile(rb"^(\w+):\s+(\d+)", re.M)
+ARCSIZE = re.compile(rb"^size\s+\d+\s+(\d+)", re.M)
+ARCSTAT = re.compile(rb"^(\w+)\s+\d+\s+(\d+)", re.M)
+# major, minor, name, reads, merged, sectors read, ms, writes, merged, sectors written
+DISKSTATS = re.compile(
+    rb"^\s*\d+\s+\d+\s+(\S+)\s+\d+\s+\d+\s+(\d+)\s+\d+\s+\d+\s+\d+\s+(\d+)", re.M
+)
+PROCSTAT = re.compile(rb"^cpu(\d+)" + rb"\s+(\d+)" * 8, re.M)
 
 
 def main():
@@ -35,32 +90,84 @@ def main():
     Entry point for statusline-i3.py
     """
     global PAGESIZE
-    PAGESIZE = sysctlbyname("hw.pagesize", convert=to_int)
+    PAGESIZE = os.sysconf("SC_PAGESIZE")
     args = setup()
+    global METRICS
+    METRICS = Metrics(args.history)
+    funcs = backend()
     mailboxes = {name: {} for name in args.mailbox.split(":")}
+    watcher = mkwatcher(mailpaths(mailboxes))
     cpudata = {}
     netdata = {}
     items = [
-        ft.partial(network, storage=netdata),
-        ft.partial(mail, mailboxes=mailboxes),
-        memory,
-        ft.partial(cpu, storage=cpudata),
-        date,
+        Item("network", ft.partial(funcs["network"], storage=netdata), 1),
+        # With a watcher, mail is read when a mailbox changes.
+        Item("mail", ft.partial(mail, mailboxes=mailboxes), 60 if watcher else 5),
+        Item("memory", funcs["memory"], 5),
+        Item("cpu", ft.partial(funcs["cpu"], storage=cpudata), 1),
+        Item("date", date, 1),
     ]
-    if hasbattery():
-        items.insert(-1, battery)
+    for name in args.add or []:
+        if not funcs.get(name):
+            logging.warning(f"item {name} is not available on {sys.platform}")
+            continue
+        items.insert(-1, Item(name, ft.partial(funcs[name], storage={}), 5))
+    if funcs["hasbattery"]():
+        items.insert(-1, Item("battery", funcs["battery"], 30))
+    sel = selectors.DefaultSelector()
+    if watcher:
+        sel.register(watcher, selectors.EVENT_READ, items[1])
+    if args.json:
+        try:
+            sel.register(ClickReader(sys.stdin.fileno(), items), selectors.EVENT_READ)
+        except OSError:
+            logging.warning("cannot read click events from standard input")
+    server = None
+    if args.socket:
+        try:
+            server = MetricsServer(args.socket, METRICS)
+            sel.register(server, selectors.EVENT_READ)
+        except OSError as e:
+            logging.warning(f"cannot listen on {args.socket}: {e}")
+    pool = cf.ThreadPoolExecutor(max_workers=len(items))
+    waker = Waker()
+    sel.register(waker, selectors.EVENT_READ)
+    signal.signal(signal.SIGUSR1, sigusr1)
     logging.info("starting")
     sys.stdout.reconfigure(line_buffering=True)  # Flush every line.
+    if args.json:
+        print(json.dumps({"version": 1, "click_events": True}))
+        print("[")
     rv = 0
     # Run
     try:
+        line = None
         while True:
-            start = time.monotonic()
-            print(" | ".join(item() for item in items))
-            end = time.monotonic()
-            delta = end - start
-            if delta < 1:
-                time.sleep(1 - delta)
+            now = time.monotonic()
+            due = [item for item in items if item.due <= now]
+            started = list(filter(None, (item.start(pool, waker) for item in due)))
+            if started:
+                cf.wait(started, timeout=max(item.deadline for item in due))
+            for item in items:
+                item.collect()
+            tick = time.monotonic() - now
+            if tick > TICK_BUDGET:
+                logging.warning(f"tick took {tick:.3f} s")
+            if DUMPSTATS:
+                logstats(items)
+            if args.json:
+                newline = "[" + ",".join(item.fragment() for item in items) + "],"
+            else:
+                newline = " | ".join(item.fulltext() for item in items)
+            if newline != line:
+                print(newline)
+                line = newline
+            timeout = min(item.due for item in items) - time.monotonic()
+            for key, _ in sel.select(max(timeout, 0)):
+                if key.fileobj.read() and key.data:
+                    key.data.due = 0
+    except EOFError:
+        logging.info("standard input was closed; exiting")
     except Exception:
         # Occasionally, statusline-i3 dies, and I don't know why.
         # This should catch what happens next time. :-)
@@ -69,12 +176,15 @@ def main():
     except KeyboardInterrupt:
         # This is mainly for when testing from the command-line.
         logging.info("caught KeyboardInterrupt; exiting")
+    if server:
+        server.close()
     return rv
 
 
 def setup():
     """Configure logging, process command-line arguments."""
-    syslog = SysLogHandler(address="/var/run/log", facility=SysLogHandler.LOG_LOCAL3)
+    address = "/var/run/log" if os.path.exists("/var/run/log") else "/dev/log"
+    syslog = SysLogHandler(address=address, facility=SysLogHandler.LOG_LOCAL3)
     pid = os.getpid()
     syslog.ident = f"statusline-i3[{pid}]: "
     logging.basicConfig(
@@ -88,9 +198,57 @@ def setup():
         "--mailbox",
         type=str,
         default=os.environ["MAIL"],
-        help="Location of the mailboxes. One or more mailbox names separated by ‘:’",
+        help="Location of the mailboxes (mbox or Maildir), separated by ‘:’",
+    )
+    opts.add_argument(
+        "-a",
+        "--add",
+        action="append",
+        choices=["top", "arc", "disk"],
+        help="Add an item (top: busiest processes, arc: ZFS ARC hit ratio, "
+        "disk: disk throughput); can be used more than once",
+    )
+    rundir = os.environ.get("XDG_RUNTIME_DIR", "/tmp")
+    opts.add_argument(
+        "-s",
+        "--socket",
+        type=str,
+        nargs="?",
+        const=os.path.join(rundir, f"statusline-i3-{os.getuid()}.sock"),
+        help="Answer queries for the metrics on a Unix-domain socket "
+        "(default location: %(const)s)",
     )
-    return opts.parse_args(sys.argv[1:])
+    opts.add_argument(
+        "--history",
+        type=int,
+        default=600,
+        help="Number of samples to keep per metric (default: %(default)s); "
+        "items are sampled every 1 to 60 s",
+    )
+    opts.add_argument(
+        "-j",
+        "--json",
+        action="store_true",
+        help="Use the i3bar JSON protocol, with colors and click events",
+    )
+    args = opts.parse_args(sys.argv[1:])
+    if args.history < 1:
+        opts.error("the history must be at least one sample")
+    return args
+
+
+def sigusr1(signum, frame):
+    """Signal handler; request that the latency statistics are logged."""
+    global DUMPSTATS
+    DUMPSTATS = True
+
+
+def logstats(items):
+    """Write the latency histograms of the items to the log."""
+    global DUMPSTATS
+    DUMPSTATS = False
+    for item in items:
+        logging.info(f"latency of {item.name}: {item.histogram.summary()}")
 
 
 # Low level functions.
@@ -101,11 +259,6 @@ def to_int(value):
     return int.from_bytes(value, byteorder="little")
 
 
-def to_degC(value):
-    """Convert binary sysctl value to degree Centigrade."""
-    return round(int.from_bytes(value, byteorder="little") / 10 - 273.15, 1)
-
-
 def sysctlbyname(name, buflen=4, convert=None):
     """
     Python wrapper for sysctlbyname(3) on FreeBSD.
@@ -165,6 +318,127 @@ def sysctl(name, buflen=4, convert=None):
     return oldp.raw[:buflen]
 
 
+class Sysctl:
+    """
+    A sysctl(3) that is looked up by name once, and then read repeatedly.
+
+    The MIB, the data buffer and the arguments for sysctl(3) are created
+    in advance, so reading the value does not allocate ctypes objects.
+    After update(), the length of the returned data is in oldlen.value.
+
+    Arguments:
+        name: Name (str) or numeric MIB (list of int) of the sysctl to query.
+        fmt (str): struct format of the data. Defaults to "I" (unsigned int).
+    """
+
+    __slots__ = ("name", "struct", "buf", "view", "oldlen", "args")
+
+    def __init__(self, name, fmt="I"):
+        if isinstance(name, str):
+            mib = (ctypes.c_int * CTL_MAXNAME)()
+            miblen = ctypes.c_size_t(CTL_MAXNAME)
+            rv = libc.sysctlnametomib(
+                ctypes.c_char_p(bytes(name, encoding="ascii")),
+                mib,
+                ctypes.byref(miblen),
+            )
+            if rv != 0:
+                errno = ctypes.get_errno()
+                raise ValueError(f"sysctlnametomib error for {name}: {errno}")
+        else:  # Numeric MIB
+            mib = (ctypes.c_int * len(name))(*name)
+            miblen = ctypes.c_size_t(len(name))
+        self.name = name
+        self.struct = struct.Struct(fmt)
+        self.buf = ctypes.create_string_buffer(self.struct.size)
+        self.view = memoryview(self.buf).cast("B")
+        self.oldlen = ctypes.c_size_t(self.struct.size)
+        self.args = (
+            mib,
+            ctypes.c_uint(miblen.value),
+            self.buf,
+            ctypes.byref(self.oldlen),
+            None,
+            ctypes.c_size_t(0),
+        )
+
+    def update(self):
+        """Read the sysctl into the data buffer, which is also available as view."""
+        self.oldlen.value = self.struct.size
+        if libc.sysctl(*self.args) != 0:
+            errno = ctypes.get_errno()
+            raise ValueError(f"sysctl error for {self.name}: {errno}")
+
+    def read(self):
+        """Return the data of the sysctl as a tuple, unpacked according to fmt."""
+        self.update()
+        return self.struct.unpack_from(self.buf)
+
+
+def growupdate(sc):
+    """
+    Update a Sysctl with variable-length data, enlarging the buffer if needed.
+
+    Returns:
+        The Sysctl that was updated; a new one if the buffer was too small.
+    """
+    while True:
+        try:
+            sc.update()
+            return sc
+        except ValueError:
+            if ctypes.get_errno() != errno.ENOMEM:
+                raise
+            sc = Sysctl(sc.name, f"{2 * sc.struct.size}s")
+
+
+@ft.cache
+def cachedsysctl(name, fmt="I"):
+    """Return the Sysctl for the given name and format, creating it once."""
+    return Sysctl(name, fmt)
+
+
+class ProcFile:
+    """
+    A file in /proc or /sys that is opened once, and then read repeatedly.
+
+    The file is read with preadv(2) into a buffer that is reused.
+
+    Arguments:
+        path (str): Location of the file.
+        size (int): Initial size of the buffer.
+    """
+
+    __slots__ = ("fd", "buf", "view")
+
+    def __init__(self, path, size=4096):
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    def read(self):
+        """Return a memoryview of the contents of the file."""
+        while True:
+            n = os.preadv(self.fd, [self.buf], 0)
+            if n < len(self.buf):
+                return self.view[:n]
+            # The buffer was too small.
+            self.view.release()
+            self.buf = bytearray(2 * len(self.buf))
+            self.view = memoryview(self.buf)
+
+
+@ft.cache
+def procfile(path, size=4096):
+    """
+    Return the ProcFile for the given path, opening it once.
+
+    The items are updated concurrently, so a file that is read by more than
+    one item must not be opened with this function; the buffer is shared.
+    """
+    return ProcFile(path, size)
+
+
 def setproctitle(name):
     """
     Change the name of the process
@@ -172,11 +446,572 @@ def setproctitle(name):
     Arguments:
         name (bytes): the new name for the process.
     """
+    if not hasattr(libc, "setproctitle"):  # Linux
+        libc.prctl(15, ctypes.c_char_p(name), 0, 0, 0)  # PR_SET_NAME
+        return
     fmt = ctypes.c_char_p(b"-%s")
     value = ctypes.c_char_p(name)
     libc.setproctitle(fmt, value)
 
 
+# Scheduling and watching files.
+
+
+class Item:
+    """
+    A block on the status line.
+
+    The item is updated in a thread pool. If an update takes longer than
+    the deadline, the previous text is shown marked as stale, and no new
+    update is started until the running one has finished.
+
+    Arguments:
+        name (str): name of the block.
+        func: function without arguments that returns the text to display, or
+            a tuple of the text and a level (None, "warning" or "urgent").
+        interval (float): time in seconds between updates.
+        deadline (float): time in seconds that an update may take.
+    """
+
+    __slots__ = (
+        "name",
+        "func",
+        "interval",
+        "deadline",
+        "due",
+        "text",
+        "level",
+        "stale",
+        "json",
+        "future",
+        "started",
+        "latency",
+        "histogram",
+        "late",
+    )
+
+    def __init__(self, name, func, interval, deadline=0.25):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.deadline = deadline
+        self.due = 0
+        self.text = ""
+        self.level = None
+        self.stale = False
+        self.json = None
+        self.future = None
+        self.started = 0.0
+        self.latency = 0.0
+        self.histogram = Histogram()
+        self.late = False
+
+    def start(self, pool, callback):
+        """
+        Schedule the next update and start an update in the pool, unless the
+        previous one is still running.
+
+        Arguments:
+            pool: concurrent.futures.Executor to run the update.
+            callback: called with the future when an update is done that
+                collect() did not find finished.
+
+        Returns:
+            The future of the update, or None if no update was started.
+        """
+        now, wall = time.monotonic(), time.time()
+        # Align updates with the wall clock, so that items with the same
+        # interval are updated in the same wakeup.
+        self.due = now + self.interval - wall % self.interval
+        if self.future:
+            return None
+        self.started = now
+        self.late = False
+        self.future = pool.submit(self.update)
+        self.future.add_done_callback(ft.partial(self.finished, callback))
+        return self.future
+
+    def finished(self, callback, future):
+        """Call callback for an update that finished after collect() looked."""
+        if self.late:
+            callback(future)
+
+    def update(self):
+        """Call func and record how long it took. Runs in a worker thread."""
+        start = time.monotonic()
+        try:
+            return self.func()
+        finally:
+            self.latency = time.monotonic() - start
+            self.histogram.record(int(self.latency * 1e6))
+
+    def collect(self):
+        """Use the result of a finished update, or mark a late one as stale."""
+        if not self.future:
+            return
+        # Set before checking, so that finished() cannot miss a late update.
+        self.late = True
+        if not self.future.done():
+            if not self.stale and time.monotonic() - self.started > self.deadline:
+                logging.warning(f"{self.name} missed its deadline")
+                self.stale, self.json = True, None
+            return
+        future, self.future = self.future, None
+        try:
+            rv = future.result()
+        except Exception:
+            logging.error(f"updating {self.name} failed: " + traceback.format_exc())
+            self.stale, self.json = True, None
+            return
+        text, level = rv if isinstance(rv, tuple) else (rv, None)
+        if text != self.text or level != self.level or self.stale:
+            self.text, self.level, self.stale, self.json = text, level, False, None
+
+    def fulltext(self):
+        """Return the text to display."""
+        if self.stale:
+            return self.text + STALE
+        return self.text
+
+    def fragment(self):
+        """Return the block as JSON for the i3bar protocol."""
+        if self.json is None:
+            block = {"name": self.name, "full_text": self.fulltext()}
+            if self.stale:
+                block["color"] = COLORS["stale"]
+            elif self.level:
+                block["color"] = COLORS[self.level]
+            if self.level == "urgent":
+                block["urgent"] = True
+            self.json = json.dumps(block, ensure_ascii=False)
+        return self.json
+
+
+class Waker:
+    """
+    Self-pipe that wakes up the main loop when a late update has finished.
+
+    It is called for the futures of updates that collect() did not find done.
+    """
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        os.set_blocking(self.rfd, False)
+        os.set_blocking(self.wfd, False)
+
+    def __call__(self, future):
+        try:
+            os.write(self.wfd, b"x")
+        except BlockingIOError:  # Pipe is full; the main loop will wake up anyway.
+            pass
+
+    def fileno(self):
+        return self.rfd
+
+    def read(self):
+        """Empty the pipe. Always returns False."""
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return False
+
+
+class Histogram:
+    """
+    Histogram of latencies in µs, with fixed buckets like HdrHistogram.
+
+    Values below 16 µs have their own bucket. Above that, every power of
+    two is split in 8 buckets, so the relative error is less than 12.5%.
+    """
+
+    __slots__ = ("counts", "total", "max")
+    nbuckets = 16 + 8 * 32
+
+    def __init__(self):
+        self.counts = array("Q", [0]) * self.nbuckets
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def index(value):
+        """Return the index of the bucket for value."""
+        if value < 16:
+            return value
+        e = value.bit_length() - 4
+        return 16 + 8 * (e - 1) + (value >> e) - 8
+
+    @staticmethod
+    def upper(index):
+        """Return the highest value that fits in the bucket with the given index."""
+        if index < 16:
+            return index
+        e, m = divmod(index - 16, 8)
+        return ((m + 9) << (e + 1)) - 1
+
+    def record(self, value):
+        """Add a latency in µs."""
+        self.counts[min(self.index(value), self.nbuckets - 1)] += 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket that contains percentile p."""
+        limit, cnt = p / 100 * self.total, 0
+        for index, n in enumerate(self.counts):
+            cnt += n
+            if n and cnt >= limit:
+                return min(self.upper(index), self.max)
+        return 0
+
+    def summary(self):
+        """Return a summary of the histogram as a string."""
+        pct = ", ".join(f"p{p}={self.percentile(p)} µs" for p in (50, 90, 99))
+        return f"n={self.total}, {pct}, max={self.max} µs"
+
+
+class Ring:
+    """
+    Ring buffer with the times and values of the most recent samples.
+
+    Arguments:
+        size (int): Number of samples to keep.
+    """
+
+    __slots__ = ("times", "values", "pos", "full")
+
+    def __init__(self, size):
+        self.times = array("d", [0.0]) * size
+        self.values = array("d", [0.0]) * size
+        self.pos = 0
+        self.full = False
+
+    def append(self, t, value):
+        """Add a sample, overwriting the oldest one if the buffer is full."""
+        self.times[self.pos], self.values[self.pos] = t, value
+        self.pos += 1
+        if self.pos == len(self.times):
+            self.pos, self.full = 0, True
+
+    def samples(self, since=0.0):
+        """Return a list of (time, value) tuples from the given time, oldest first."""
+        order = it.chain(
+            range(self.pos, len(self.times)) if self.full else (), range(self.pos)
+        )
+        return [
+            (self.times[n], self.values[n]) for n in order if self.times[n] >= since
+        ]
+
+
+class Metrics:
+    """
+    Store of the recent values of the metrics, in Rings.
+
+    Items can record values from worker threads.
+
+    Arguments:
+        size (int): Number of samples to keep per metric.
+        maxmetrics (int): Maximum number of metrics. New metrics beyond this
+            are not recorded, so that memory use has an upper bound.
+    """
+
+    def __init__(self, size, maxmetrics=256):
+        self.size = size
+        self.maxmetrics = maxmetrics
+        self.rings = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, value):
+        """Record the current value of a metric."""
+        t = time.time()
+        with self.lock:
+            ring = self.rings.get(name)
+            if ring is None:
+                if len(self.rings) >= self.maxmetrics:
+                    return
+                ring = self.rings[name] = Ring(self.size)
+            ring.append(t, value)
+
+    def query(self, patterns=("*",), since=0.0):
+        """
+        Return the samples of the metrics that match one of the shell-style patterns.
+
+        Returns:
+            A dict with the names of the metrics as keys and lists of
+            (time, value) tuples as values.
+        """
+        with self.lock:
+            return {
+                name: ring.samples(since)
+                for name, ring in sorted(self.rings.items())
+                if any(fnmatch.fnmatchcase(name, p) for p in patterns)
+            }
+
+
+class MetricsServer:
+    """
+    Answer queries for metrics on a Unix-domain socket.
+
+    A client sends one line: a format (“json” or “line”), optionally followed
+    by shell-style patterns for the metric names and “since=N” to only get
+    the last N seconds. The answer is a JSON object with a list of
+    [time, value] pairs per metric, or InfluxDB line protocol. Then the
+    connection is closed.
+
+    A socket left behind by a previous run is replaced. If another process is
+    listening on it or the path is not a socket, OSError is raised.
+
+    Arguments:
+        path (str): Location of the socket.
+        metrics: Metrics instance.
+    """
+
+    def __init__(self, path, metrics):
+        self.path = path
+        self.metrics = metrics
+        if os.path.exists(path):
+            if not S_ISSOCK(os.stat(path).st_mode):
+                raise FileExistsError(errno.EEXIST, "not a socket", path)
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(path)
+                except ConnectionRefusedError:  # Stale socket.
+                    os.unlink(path)
+                else:
+                    raise OSError(errno.EADDRINUSE, "socket is in use", path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o600)
+        self.sock.listen(5)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        """Answer a query. Always returns False."""
+        try:
+            conn, _ = self.sock.accept()
+        except BlockingIOError:
+            return False
+        with conn:
+            try:
+                request = self.receive(conn).decode("ascii", "replace")
+                # Since Python 3.5, the timeout applies to sendall as a whole.
+                conn.settimeout(QUERY_TIMEOUT)
+                conn.sendall(self.answer(request.split()).encode("utf-8"))
+            except OSError as e:
+                logging.warning(f"metrics query failed: {e}")
+        return False
+
+    def receive(self, conn):
+        """
+        Return the first line of a request, of at most 1024 bytes.
+
+        A slow client should not stall the status line, so the whole request
+        must arrive within QUERY_TIMEOUT; otherwise TimeoutError is raised.
+        """
+        deadline = time.monotonic() + QUERY_TIMEOUT
+        request = b""
+        while b"\n" not in request and len(request) < 1024:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("request took too long")
+            conn.settimeout(remaining)
+            data = conn.recv(1024 - len(request))
+            if not data:
+                break
+            request += data
+        return request.split(b"\n", 1)[0]
+
+    def answer(self, words):
+        """Return the answer for the words of a request."""
+        form = words[0] if words else "json"
+        patterns = [w for w in words[1:] if not w.startswith("since=")] or ["*"]
+        since = 0.0
+        for w in words[1:]:
+            if w.startswith("since="):
+                try:
+                    since = time.time() - float(w[6:])
+                except ValueError:
+                    return "error: invalid since\n"
+        data = self.metrics.query(patterns, since)
+        if form == "json":
+            return json.dumps(data) + "\n"
+        if form == "line":
+            return "".join(
+                f"{name} value={v} {int(t * 1e9)}\n"
+                for name, samples in data.items()
+                for t, v in samples
+            )
+        return f"error: unknown format {form}\n"
+
+    def close(self):
+        self.sock.close()
+        os.unlink(self.path)
+
+
+class ClickReader:
+    """
+    Read i3bar click events from a non-blocking file descriptor.
+
+    A click on a block makes it update immediately.
+
+    Arguments:
+        fd (int): file descriptor to read.
+        items: list of Item.
+    """
+
+    def __init__(self, fd, items):
+        os.set_blocking(fd, False)
+        self.fd = fd
+        self.items = {item.name: item for item in items}
+        self.buf = b""
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Handle the available click events. Always returns False."""
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+        if not data:
+            raise EOFError("no more click events")
+        *lines, self.buf = (self.buf + data).split(b"\n")
+        for ln in lines:
+            # The events form an infinite JSON array, one event per line.
+            ln = ln.strip().lstrip(b"[,")
+            if not ln:
+                continue
+            try:
+                event = json.loads(ln)
+            except ValueError:
+                logging.warning(f"invalid click event: {ln}")
+                continue
+            if event.get("name") in self.items:
+                self.items[event["name"]].due = 0
+        return False
+
+
+class KqueueWatcher:
+    """
+    Watch files and directories for changes with kqueue(2).
+
+    The parent directory of a file is watched as well, so that a mailbox
+    that is replaced by another file can be watched again.
+    """
+
+    def __init__(self, paths):
+        self.kq = select.kqueue()
+        self.fds = {}
+        for path in paths:
+            self._watch(path)
+            if not os.path.isdir(path):
+                self._watch(os.path.dirname(os.path.abspath(path)))
+
+    def _watch(self, path):
+        if path in self.fds:
+            os.close(self.fds[path])
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        ev = select.kevent(
+            fd,
+            filter=select.KQ_FILTER_VNODE,
+            flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+            fflags=select.KQ_NOTE_WRITE
+            | select.KQ_NOTE_EXTEND
+            | select.KQ_NOTE_ATTRIB
+            | select.KQ_NOTE_DELETE
+            | select.KQ_NOTE_RENAME,
+        )
+        self.kq.control([ev], 0, 0)
+        self.fds[path] = fd
+
+    def fileno(self):
+        return self.kq.fileno()
+
+    def read(self):
+        """Handle pending events. Returns True if a watched path has changed."""
+        if not self.kq.control(None, 32, 0):
+            return False
+        # Follow files that were replaced.
+        for path, fd in list(self.fds.items()):
+            try:
+                if os.stat(path).st_ino != os.fstat(fd).st_ino:
+                    self._watch(path)
+            except FileNotFoundError:
+                pass
+        return True
+
+
+class InotifyWatcher:
+    """
+    Watch files and directories for changes with inotify(7).
+
+    For files, the parent directory is watched and the events are filtered
+    by name. That way a file that is replaced keeps being watched.
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    mask = 0x2 | 0x4 | 0x8 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, paths):
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.names = {}
+        for path in paths:
+            if os.path.isdir(path):
+                dirname, name = path, b""
+            else:
+                dirname, name = os.path.split(os.path.abspath(path))
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(dirname), self.mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"cannot watch {dirname}")
+            self.names.setdefault(wd, set()).add(os.fsencode(name))
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Handle pending events. Returns True if a watched path has changed."""
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, _, _, namelen = struct.unpack_from("iIII", data, offset)
+                offset += 16
+                name = data[offset : offset + namelen].rstrip(b"\x00")
+                offset += namelen
+                names = self.names.get(wd, ())
+                if b"" in names or name in names:
+                    changed = True
+        return changed
+
+
+def mkwatcher(paths):
+    """
+    Create a watcher for the given paths.
+
+    Returns:
+        A KqueueWatcher or InotifyWatcher, or None if the paths cannot be watched.
+    """
+    try:
+        if hasattr(select, "kqueue"):
+            return KqueueWatcher(paths)
+        if hasattr(libc, "inotify_init1"):
+            return InotifyWatcher(paths)
+    except OSError as e:
+        logging.warning(f"cannot watch mailboxes: {e}")
+    return None
+
+
 # Helper functions.
 
 
@@ -192,14 +1027,169 @@ def fmt(nbytes):
     return f"{nbytes}B"
 
 
+def smooth(c, ibytes, obytes, dt, alpha):
+    """
+    Update the exponentially smoothed rates of a network interface.
+
+    Arguments:
+        c: list of [ibytes, obytes, inrate, outrate] from the previous run.
+            This list will be *modified* by this function.
+        ibytes (int): The new number of bytes received.
+        obytes (int): The new number of bytes sent.
+        dt (float): Time in seconds since the previous run.
+        alpha (float): Smoothing factor.
+    """
+    if dt > 0 and c[0]:
+        c[2] += alpha * ((ibytes - c[0]) / dt - c[2])
+        c[3] += alpha * ((obytes - c[1]) / dt - c[3])
+    c[0], c[1] = ibytes, obytes
+
+
+def netreport(interfaces):
+    """
+    Record the rates of network interfaces, and format them for display.
+
+    Arguments:
+        interfaces: iterable of (name, counters) tuples, where counters is
+            the list updated by smooth().
+
+    Returns:
+        A string to display.
+    """
+    items = []
+    for name, c in interfaces:
+        METRICS.record(f"net.{name}.in", c[2])
+        METRICS.record(f"net.{name}.out", c[3])
+        items.append(f"{name}: {fmt(c[2])}/{fmt(c[3])}")
+    return "  ".join(items)
+
+
+def cpuload(storage, cur, temps):
+    """
+    Report the CPU usage and temperature.
+
+    The usage is shown as the mean and maximum over all cores, followed by a
+    sparkline with the usage per core.
+
+    Arguments:
+        storage: The storage dict of the cpu item. This will be *modified*.
+        cur: Sequence of the CPUSTATES time counters for every core.
+        temps: List of temperatures in °C. Can be empty.
+
+    Returns:
+        A string to display and a level.
+    """
+    if "prev" not in storage:
+        storage["prev"] = array("l", [0]) * len(cur)
+    prev = storage["prev"]
+    # For every core, the states are (according to /usr/include/sys/resource.h):
+    # USER, NICE, SYS, INT, IDLE
+    diff = array("l", map(op.sub, cur, prev))
+    memoryview(prev)[:] = cur  # Save values for the next run.
+    totals = list(map(sum, zip(*[iter(diff)] * CPUSTATES)))
+    used = list(map(op.sub, totals, diff[CPUSTATES - 1 :: CPUSTATES]))
+    # The counters of CPU IDs that are absent or offline do not change.
+    loads = [u / t for u, t in zip(used, totals) if t > 0] or [0.0]
+    mean = int(100 * sum(used) / max(sum(totals), 1))
+    spark = "".join(
+        SPARKS[min(int(load * len(SPARKS)), len(SPARKS) - 1)] for load in loads
+    )
+    METRICS.record("cpu.load", mean)
+    METRICS.record("cpu.max", 100 * max(loads))
+    text = f"CPU: {mean}%/{int(100 * max(loads))}% {spark}"
+    level = "warning" if mean >= 90 else None
+    if temps:
+        T = round(stat.mean(temps))
+        METRICS.record("cpu.temp", T)
+        text += f", {T}°C"
+        if T >= 80:
+            level = "urgent"
+    return text, level
+
+
+def batterylevel(percent, state):
+    """Return the level for a battery with the given charge and state."""
+    if state == "CRITICAL!":
+        return "urgent"
+    if state == "discharging" and percent < 15:
+        return "warning"
+    return None
+
+
+def arcratio(storage, hits, misses):
+    """
+    Report the hit ratio of the ZFS ARC since the previous run.
+
+    Arguments:
+        storage: The storage dict of the arc item. This will be *modified*.
+        hits (int): Total number of ARC hits.
+        misses (int): Total number of ARC misses.
+
+    Returns:
+        A string to display.
+    """
+    dh = hits - storage.get("hits", 0)
+    dm = misses - storage.get("misses", 0)
+    # Save values for the next run.
+    storage["hits"], storage["misses"] = hits, misses
+    if dh + dm == 0:
+        return "ARC: -"
+    ratio = 100 * dh / (dh + dm)
+    METRICS.record("arc.hitratio", ratio)
+    return f"ARC: {ratio:.1f}%"
+
+
+def diskrates(storage, names, reads, writes):
+    """
+    Report the read and write throughput of disks.
+
+    Arguments:
+        storage: The storage dict of the disk item. This will be *modified*.
+        names: Sequence of disk names. Disks named None are not shown.
+            When this changes, the previous values are discarded.
+        reads: Sequence of the total number of bytes read, for every disk.
+        writes: Sequence of the total number of bytes written, for every disk.
+
+    Returns:
+        A string to display.
+    """
+    tm = time.monotonic()
+    if storage.get("disks") != names:
+        storage["disks"] = names
+        storage["reads"] = array("Q", reads)
+        storage["writes"] = array("Q", writes)
+        storage["time"] = tm
+        return "  ".join(f"{name}: 0B/0B" for name in names if name)
+    dt = max(tm - storage["time"], 1e-3)
+    prevr, prevw = storage["reads"], storage["writes"]
+    dr = map(op.sub, reads, prevr)
+    dw = map(op.sub, writes, prevw)
+    items = []
+    for name, r, w in zip(names, dr, dw):
+        if name:
+            METRICS.record(f"disk.{name}.read", r / dt)
+            METRICS.record(f"disk.{name}.write", w / dt)
+            items.append(f"{name}: {fmt(r / dt)}/{fmt(w / dt)}")
+    # Save values for the next run.
+    memoryview(prevr)[:] = reads
+    memoryview(prevw)[:] = writes
+    storage["time"] = tm
+    return "  ".join(items)
+
+
 def readmbox(mboxname, storage):
     """
     Report unread mail.
 
+    The offsets of the messages and their read flags are kept in storage.
+    If the mailbox has only grown since the previous call, just the tail is
+    scanned. A truncated or rewritten mailbox is scanned completely.
+
     Arguments:
         mboxname (str): name of the mailbox to read.
-        storage: a dict with keys (unread, time, size) from the previous call
-            or an empty dict. This dict will be *modified* by this function.
+        storage: a dict with keys (unread, time, size, offsets, flags, tail)
+            from the previous call or an empty dict. This dict will be
+            *modified* by this function.
 
     Returns: The number of unread messages in this mailbox.
     """
@@ -209,40 +1199,147 @@ def readmbox(mboxname, storage):
     # file. See also stat(2).
     newtime = stats.st_ctime
     newsize = stats.st_size
-    if stats.st_size == 0:
-        storage["unread"] = 0
-        storage["time"] = newtime
-        storage["size"] = 0
+    if newsize == 0:
+        storage.update(
+            unread=0,
+            time=newtime,
+            size=0,
+            offsets=array("Q"),
+            flags=bytearray(),
+            tail=b"",
+        )
         return 0
-    if not storage or newtime > storage["time"] or newsize != storage["size"]:
-        with open(mboxname) as mbox:
-            with mmap.mmap(mbox.fileno(), 0, prot=mmap.PROT_READ) as mm:
-                start, total = (
-                    0,
-                    1,
-                )  # First mail is not found; it starts on first line...
-                while True:
-                    rv = mm.find(b"\n\nFrom ", start)
-                    if rv == -1:
-                        break
-                    else:
-                        total += 1
-                        start = rv + 7
-                start, read = 0, 0
-                while True:
-                    rv = mm.find(b"\nStatus: R", start)
-                    if rv == -1:
-                        break
-                    else:
-                        read += 1
-                        start = rv + 10
-        unread = total - read
-        if unread < 0:
-            unread = 0
-        # Save values for the next run.
-        storage["unread"], storage["time"], storage["size"] = unread, newtime, newsize
-    else:
-        unread = storage["unread"]
+    if "time" in storage and newtime <= storage["time"] and newsize == storage["size"]:
+        return storage["unread"]
+    with open(mboxname, "rb") as mbox:
+        with mmap.mmap(mbox.fileno(), 0, prot=mmap.PROT_READ) as mm:
+            newsize = len(mm)
+            oldsize, tail = storage.get("size", 0), storage.get("tail", b"")
+            offsets, flags = storage.get("offsets"), storage.get("flags")
+            if (
+                offsets
+                and newsize > oldsize
+                and mm[oldsize - len(tail) : oldsize] == tail
+            ):
+                # Mail was appended. The last known message is scanned again,
+                # since its end might have moved.
+                start = offsets.pop()
+                flags.pop()
+            else:
+                offsets, flags, start = array("Q"), bytearray(), 0
+            scanmbox(mm, start, offsets, flags)
+            tail = mm[max(newsize - 256, 0) : newsize]
+    unread = len(flags) - flags.count(1)
+    # Save values for the next run.
+    storage.update(
+        unread=unread,
+        time=newtime,
+        size=newsize,
+        offsets=offsets,
+        flags=flags,
+        tail=tail,
+    )
+    return unread
+
+
+def scanmbox(mm, start, offsets, flags):
+    """
+    Find the messages in (part of) an mbox file.
+
+    Arguments:
+        mm (mmap): the mapped mailbox.
+        start (int): offset of the first message to scan.
+        offsets (array): the start offsets of messages are appended to this.
+        flags (bytearray): for every message found, 1 (read) or 0 (unread)
+            is appended to this.
+    """
+    end = len(mm)
+    while start < end:
+        nxt = mm.find(b"\n\nFrom ", start)
+        stop = end if nxt == -1 else nxt + 2
+        hdrend = mm.find(b"\n\n", start, stop)
+        if hdrend == -1:
+            hdrend = stop
+        offsets.append(start)
+        flags.append(mm.find(b"\nStatus: R", start, hdrend) != -1)
+        start = stop
+
+
+def backend():
+    """Return a dict of the functions for the items that depend on the OS."""
+    if sys.platform.startswith("linux"):
+        return {
+            "network": network_linux,
+            "memory": memory_linux,
+            "cpu": cpu_linux,
+            "battery": battery_linux,
+            "hasbattery": hasbattery_linux,
+            "top": None,
+            "arc": arc_linux,
+            "disk": disk_linux,
+        }
+    return {
+        "network": network,
+        "memory": memory,
+        "cpu": cpu,
+        "battery": battery,
+        "hasbattery": hasbattery,
+        "top": top,
+        "arc": arc,
+        "disk": disk,
+    }
+
+
+def ismaildir(path):
+    """Check if path is a Maildir."""
+    return all(os.path.isdir(os.path.join(path, sub)) for sub in ("cur", "new", "tmp"))
+
+
+def mailpaths(mailboxes):
+    """Return the paths that must be watched for changes in the mailboxes."""
+    paths = []
+    for name in mailboxes:
+        if ismaildir(name):
+            paths += [os.path.join(name, "new"), os.path.join(name, "cur")]
+        else:
+            paths.append(name)
+    return paths
+
+
+def readmaildir(path, storage):
+    """
+    Report unread mail in a Maildir.
+
+    Messages in new/ are unread. Messages in cur/ are unread unless the flags
+    in their name (after “:2,”) contain “S” (seen). The directories are only
+    scanned when their mtime has changed.
+
+    Arguments:
+        path (str): location of the Maildir.
+        storage: a dict with keys (unread, mtimes) from the previous call
+            or an empty dict. This dict will be *modified* by this function.
+
+    Returns: The number of unread messages in this Maildir.
+    """
+    new, cur = os.path.join(path, "new"), os.path.join(path, "cur")
+    # Get the mtimes before scanning, so changes during the scan are not missed.
+    mtimes = (os.stat(new).st_mtime_ns, os.stat(cur).st_mtime_ns)
+    if storage.get("mtimes") == mtimes:
+        return storage["unread"]
+    unread = 0
+    with os.scandir(new) as entries:
+        for entry in entries:
+            if not entry.name.startswith("."):
+                unread += 1
+    with os.scandir(cur) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            _, sep, flags = entry.name.rpartition(":2,")
+            if not sep or "S" not in flags:
+                unread += 1
+    # Save values for the next run.
+    storage["unread"], storage["mtimes"] = unread, mtimes
     return unread
 
 
@@ -260,120 +1357,263 @@ def hasbattery():
 # Functions for generating the items.
 
 
+def iftable(cnt, storage):
+    """
+    (Re)build the table of network interfaces.
+
+    Arguments:
+        cnt (int): The highest interface index.
+        storage: The storage dict of network(). This will be *modified*.
+    """
+    names = {}
+    for n in range(1, cnt + 1):
+        try:
+            data = sysctl([4, 18, 0, 2, n, 1], buflen=208)  # ifmib row n.
+        except ValueError:  # Interface was removed.
+            continue
+        names[n] = data[:16].strip(b"\x00").decode("ascii")
+    storage["count"], storage["names"] = cnt, names
+    old = storage.get("counters", {})
+    storage["counters"] = {n: old.get(n, [0, 0, 0.0, 0.0]) for n in names}
+    if "iflist" not in storage:
+        storage["iflist"] = Sysctl(IFLIST_MIB, f"{8192 + 1024 * cnt}s")
+
+
 def network(storage):
     """
     Report on bytes in/out for the network interfaces.
 
+    The counters of all interfaces are read with a single sysctl. The rates
+    are exponentially smoothed with time constant NET_TAU.
+
     Arguments:
-        storage: A dict of {interface: (inbytes, outbytes, time)} or an empty dict.
+        storage: A dict from the previous run or an empty dict.
             This dict will be *modified* by this function.
 
     Returns:
         A string to display.
     """
-    cnt = sysctlbyname("net.link.generic.system.ifcount", convert=to_int)
-    items = []
-    for n in range(1, cnt + 1):
-        tm = time.monotonic()
-        data = sysctl([4, 18, 0, 2, n, 1], buflen=208)
-        name = data[:16].strip(b"\x00").decode("ascii")
-        if name.startswith("lo"):
+    (cnt,) = cachedsysctl("net.link.generic.system.ifcount", "i").read()
+    if cnt != storage.get("count"):
+        iftable(cnt, storage)
+    iflist = storage["iflist"] = growupdate(storage["iflist"])
+    tm = time.monotonic()
+    dt = tm - storage.get("time", tm)
+    alpha = 1 - math.exp(-dt / NET_TAU)
+    storage["time"] = tm
+    counters = storage["counters"]
+    view, end, offset, newif = iflist.view, iflist.oldlen.value, 0, 0
+    while offset < end:
+        msglen, msgtype = RTMSG.unpack_from(view, offset)
+        if msgtype != RTM_IFINFO:
+            offset += msglen
             continue
-        ibytes = to_int(data[120:128])
-        obytes = to_int(data[128:136])
-        if storage and name in storage:
-            dt = tm - storage[name][2]
-            d_in = fmt((ibytes - storage[name][0]) / dt)
-            d_out = fmt((obytes - storage[name][1]) / dt)
-            items.append(f"{name}: {d_in}/{d_out}")
-        else:
-            items.append(f"{name}: 0B/0B")
-        # Save values for the next run.
-        storage[name] = (ibytes, obytes, tm)
-    return "  ".join(items)
+        index, ibytes, obytes = IFMSG.unpack_from(view, offset)
+        offset += msglen
+        if index not in counters:
+            newif = max(newif, index)
+            continue
+        smooth(counters[index], ibytes, obytes, dt, alpha)
+    if newif:  # An interface was added; it will be shown next time.
+        iftable(max(cnt, newif), storage)
+    return netreport(
+        (name, counters[n])
+        for n, name in storage["names"].items()
+        if not name.startswith("lo")
+    )
 
 
 def mail(mailboxes):
     """
     Report unread mail.
 
+    Every mailbox can be an mbox file or a Maildir.
+
     Arguments:
         mailboxes: a dict of mailbox info with the paths as the keys.
 
-    Returns: A string to display.
+    Returns: A string to display and a level.
     """
     unread = 0
     for k, v in mailboxes.items():
-        unread += readmbox(k, v)
-    return f"Mail: {unread}"
+        if "maildir" not in v:
+            v["maildir"] = ismaildir(k)
+        if v["maildir"]:
+            unread += readmaildir(k, v)
+        else:
+            unread += readmbox(k, v)
+    METRICS.record("mail.unread", unread)
+    return f"Mail: {unread}", "warning" if unread else None
 
 
 def memory():
     """
     Report on the RAM usage on FreeBSD.
 
-    Returns: a string to display.
+    Returns: a string to display and a level.
     """
-    suffixes = ("page_count", "free_count", "inactive_count", "cache_count")
-    stats = {
-        suffix: sysctlbyname(f"vm.stats.vm.v_{suffix}", convert=to_int)
-        for suffix in suffixes
-    }
+    (page_count,) = cachedsysctl("vm.stats.vm.v_page_count").read()
+    (free_count,) = cachedsysctl("vm.stats.vm.v_free_count").read()
+    (inactive_count,) = cachedsysctl("vm.stats.vm.v_inactive_count").read()
+    (cache_count,) = cachedsysctl("vm.stats.vm.v_cache_count").read()
     try:
         # For systems with ZFS, count the size of the ARC as inactive.
-        arcsize = (
-            sysctlbyname("kstat.zfs.misc.arcstats.size", buflen=8, convert=to_int)
-            // PAGESIZE
-        )
+        (arcsize,) = cachedsysctl("kstat.zfs.misc.arcstats.size", "Q").read()
+        arcsize //= PAGESIZE
     except ValueError:
         arcsize = 0
-    memmax = stats["page_count"]
-    mem = (
-        memmax
-        - stats["free_count"]
-        - (stats["inactive_count"] + arcsize)
-        - stats["cache_count"]
-    )
-    usedmem = int(100 * mem / memmax)
-    return f"RAM: {usedmem}%"
+    mem = page_count - free_count - (inactive_count + arcsize) - cache_count
+    usedmem = int(100 * mem / page_count)
+    METRICS.record("memory.used", usedmem)
+    return f"RAM: {usedmem}%", "warning" if usedmem >= 90 else None
 
 
 def cpu(storage):
     """
-    Report the CPU usage and temperature.
+    Report the CPU usage and temperature on FreeBSD.
 
     Argument:
-        storage: A dict with keys (used, total) from the previous run or an empty dict.
+        storage: A dict from the previous run or an empty dict.
+            This dict will be *modified* by this function.
+
+    Returns:
+        A string to display and a level.
+    """
+    if not storage:
+        # kern.cp_times has an entry for every CPU ID up to kern.smp.maxid,
+        # which can be more than hw.ncpu if the IDs are sparse.
+        (maxid,) = cachedsysctl("kern.smp.maxid", "i").read()
+        ncpu = maxid + 1
+        cp_times = Sysctl("kern.cp_times", f"{CPUSTATES * ncpu}l")
+        temps = []
+        for n in range(ncpu):
+            try:
+                temps.append(Sysctl(f"dev.cpu.{n}.temperature", "i"))
+            except ValueError:
+                pass
+        storage.update(cp_times=cp_times, cur=cp_times.view.cast("l"), temps=temps)
+        # Take a baseline, so the first report is not the load since boot.
+        cp_times.update()
+        storage["prev"] = array("l", storage["cur"])
+        return "", None
+    storage["cp_times"].update()
+    temps = [t.read()[0] / 10 - 273.15 for t in storage["temps"]]
+    return cpuload(storage, storage["cur"], temps)
+
+
+def top(storage):
+    """
+    Report the processes that use the most CPU and memory on FreeBSD.
+
+    The process table is read with a single sysctl. The kinfo_proc structs
+    are decoded with struct.iter_unpack over a memoryview of the buffer.
+
+    Argument:
+        storage: A dict from the previous run or an empty dict.
             This dict will be *modified* by this function.
 
     Returns:
         A string to display.
     """
-    temps = [
-        sysctlbyname(f"dev.cpu.{n}.temperature", convert=to_degC) for n in range(4)
-    ]
-    T = round(stat.mean(temps))
-    resbuf = sysctlbyname("kern.cp_time", buflen=40)
-    states = struct.unpack("5L", resbuf)
-    # According to /usr/include/sys/resource.h, these are:
-    # USER, NICE, SYS, INT, IDLE
-    total = sum(states)
-    used = total - states[-1]
-    if storage:
-        prevused, prevtotal = storage["used"], storage["total"]
-        if total != prevtotal:
-            frac = int((used - prevused) / (total - prevtotal) * 100)
-        else:  # divide by 0!
-            frac = "?"
-    else:
-        frac = 0
-    # Save values for the next run.
-    storage["used"], storage["total"] = used, total
-    return f"CPU: {frac}%, {T}°C"
+    if not storage:
+        storage["procs"] = Sysctl(KERN_PROC_MIB, f"{KINFO.size * 1024}s")
+    procs = storage["procs"] = growupdate(storage["procs"])
+    cnt = procs.oldlen.value // KINFO.size
+    if cnt == 0:
+        return "Top: ?"
+    view = procs.view[: cnt * KINFO.size]
+    (structsize,) = struct.unpack_from("i", view)
+    if structsize != KINFO.size:
+        raise ValueError(f"unexpected kinfo_proc size {structsize}")
+    # Kernel processes are skipped; the pctcpu of “idle” is the sum over its
+    # threads, one per CPU.
+    busiest = largest = (-1, 0, 0)  # index, rssize, pctcpu
+    for k, (_, rssize, pctcpu, flag) in enumerate(KINFO.iter_unpack(view)):
+        if flag & P_SYSTEM:
+            continue
+        if pctcpu > busiest[2]:
+            busiest = (k, rssize, pctcpu)
+        if rssize > largest[1]:
+            largest = (k, rssize, pctcpu)
+    names = []
+    for k, _, _ in (busiest, largest):
+        if k < 0:
+            names.append("?")
+            continue
+        (comm,) = COMM.unpack_from(view, k * KINFO.size + KI_COMM)
+        names.append(comm.split(b"\x00", 1)[0].decode("utf-8", "replace"))
+    pctcpu = round(100 * busiest[2] / FSCALE)
+    rss = fmt(largest[1] * PAGESIZE)
+    return f"Top: {names[0]} {pctcpu}%, {names[1]} {rss}"
+
+
+def arc(storage):
+    """
+    Report the hit ratio of the ZFS ARC on FreeBSD.
+
+    Argument:
+        storage: A dict from the previous run or an empty dict.
+            This dict will be *modified* by this function.
+
+    Returns:
+        A string to display.
+    """
+    try:
+        (hits,) = cachedsysctl("kstat.zfs.misc.arcstats.hits", "Q").read()
+        (misses,) = cachedsysctl("kstat.zfs.misc.arcstats.misses", "Q").read()
+    except ValueError:  # No ZFS
+        return "ARC: n/a"
+    return arcratio(storage, hits, misses)
+
+
+def disk(storage):
+    """
+    Report the read and write throughput of the disks on FreeBSD.
+
+    All devstat structs are read with one sysctl. The byte counters are
+    used through a strided memoryview of the buffer. The names of the
+    disks are only decoded when the devstat generation changes.
+
+    Argument:
+        storage: A dict from the previous run or an empty dict.
+            This dict will be *modified* by this function.
+
+    Returns:
+        A string to display.
+    """
+    if not storage:
+        (numdevs,) = cachedsysctl("kern.devstat.numdevs", "i").read()
+        storage["devstat"] = Sysctl(
+            "kern.devstat.all", f"{8 + DEVSTAT_SIZE * numdevs}s"
+        )
+        storage["generation"] = storage["count"] = None
+    devstat = storage["devstat"] = growupdate(storage["devstat"])
+    view = devstat.view
+    cnt = (devstat.oldlen.value - 8) // DEVSTAT_SIZE
+    (generation,) = struct.unpack_from("l", view)
+    if generation != storage["generation"] or cnt != storage["count"]:
+        # The list of devices has changed.
+        names = []
+        for name, unit, devtype in DEVNAME.iter_unpack(
+            view[8 : 8 + cnt * DEVSTAT_SIZE]
+        ):
+            # Only show direct access devices, not e.g. pass-through devices.
+            if (devtype & 0x10F) == 0:
+                names.append(name.split(b"\x00", 1)[0].decode() + str(unit))
+            else:
+                names.append(None)
+        storage.update(generation=generation, count=cnt, names=names)
+    # View of the buffer as 64-bit words. The bytes[DEVSTAT_READ] and
+    # bytes[DEVSTAT_WRITE] counters of device n are words 10+36*n and 11+36*n.
+    words = view.cast("Q")
+    step = DEVSTAT_SIZE // 8
+    reads = words[10 : 10 + step * cnt : step]
+    writes = words[11 : 11 + step * cnt : step]
+    return diskrates(storage, storage["names"], reads, writes)
 
 
 def battery():
-    """Return battery condition as a string."""
+    """Return battery condition as a string and a level."""
     # Battery states acc. to /usr/src/sys/dev/acpica/acpiio.h
     lookup = {
         0: "on AC",
@@ -383,15 +1623,176 @@ def battery():
         4: "CRITICAL!",
         7: "unknown",
     }
-    idx = sysctlbyname("hw.acpi.battery.state", convert=to_int)
+    (idx,) = cachedsysctl("hw.acpi.battery.state", "i").read()
     state = lookup[idx]
-    percent = sysctlbyname("hw.acpi.battery.life", convert=to_int)
-    return f"Bat: {percent}% ({state})"
+    (percent,) = cachedsysctl("hw.acpi.battery.life", "i").read()
+    METRICS.record("battery.percent", percent)
+    return f"Bat: {percent}% ({state})", batterylevel(percent, state)
+
+
+# Functions for generating the items on Linux.
+
+
+def hasbattery_linux():
+    """Checks if a battery is present according to sysfs."""
+    return bool(glob.glob("/sys/class/power_supply/BAT*/capacity"))
+
+
+def network_linux(storage):
+    """
+    Report on bytes in/out for the network interfaces on Linux.
+
+    Arguments:
+        storage: A dict from the previous run or an empty dict.
+            This dict will be *modified* by this function.
+
+    Returns:
+        A string to display.
+    """
+    data = procfile("/proc/net/dev").read()
+    tm = time.monotonic()
+    dt = tm - storage.get("time", tm)
+    alpha = 1 - math.exp(-dt / NET_TAU)
+    storage["time"] = tm
+    counters = storage.setdefault("counters", {})
+    shown = []
+    for name, ibytes, obytes in NETDEV.findall(data):
+        if name.startswith(b"lo"):
+            continue
+        c = counters.setdefault(name, [0, 0, 0.0, 0.0])
+        smooth(c, int(ibytes), int(obytes), dt, alpha)
+        shown.append((name.decode(), c))
+    return netreport(shown)
+
+
+def memory_linux():
+    """
+    Report on the RAM usage on Linux.
+
+    Returns: a string to display and a level.
+    """
+    info = dict(MEMINFO.findall(procfile("/proc/meminfo").read()))
+    total, available = int(info[b"MemTotal"]), int(info[b"MemAvailable"])
+    try:
+        # For systems with ZFS, count the size of the ARC as available.
+        arc = ARCSIZE.search(procfile("/proc/spl/kstat/zfs/arcstats", 16384).read())
+        available += int(arc.group(1)) // 1024
+    except FileNotFoundError:
+        pass
+    usedmem = max(int(100 * (total - available) / total), 0)
+    METRICS.record("memory.used", usedmem)
+    return f"RAM: {usedmem}%", "warning" if usedmem >= 90 else None
+
+
+def cpu_linux(storage):
+    """
+    Report the CPU usage and temperature on Linux.
+
+    Argument:
+        storage: A dict from the previous run or an empty dict.
+            This dict will be *modified* by this function.
+
+    Returns:
+        A string to display and a level.
+    """
+    if not storage:
+        temps = []
+        for zone in sorted(glob.glob("/sys/class/thermal/thermal_zone*")):
+            with open(zone + "/type") as f:
+                if re.search(r"cpu|pkg|core|k10temp|soc", f.read()):
+                    temps.append(ProcFile(zone + "/temp", 64))
+        # /proc/stat lists CPUs by ID, which can be sparse if some are offline.
+        with open("/sys/devices/system/cpu/possible") as f:
+            ncpu = max(int(r.split("-")[-1]) for r in f.read().split(",")) + 1
+        storage.update(cur=array("l", [0]) * (CPUSTATES * ncpu), temps=temps)
+    cur = storage["cur"]
+    # user nice system idle iowait irq softirq steal
+    for fields in PROCSTAT.findall(procfile("/proc/stat", 16384).read()):
+        n, user, nice, system, idle, iowait, irq, softirq, steal = map(int, fields)
+        if CPUSTATES * n >= len(cur):
+            continue
+        cur[CPUSTATES * n : CPUSTATES * (n + 1)] = array(
+            "l", (user, nice, system, irq + softirq + steal, idle + iowait)
+        )
+    if "prev" not in storage:
+        # The first sample is the baseline; the counters since boot are no load.
+        storage["prev"] = array("l", cur)
+        return "", None
+    temps = [int(t.read()) / 1000 for t in storage["temps"]]
+    return cpuload(storage, cur, temps)
+
+
+def battery_linux():
+    """Return battery condition as a string and a level."""
+    # Battery states acc. to the power_supply class in sysfs.
+    lookup = {
+        b"Charging": "charging",
+        b"Discharging": "discharging",
+        b"Not charging": "on AC",
+        b"Full": "on AC",
+    }
+    bat = sorted(glob.glob("/sys/class/power_supply/BAT*"))[0]
+    percent = int(procfile(bat + "/capacity", 64).read())
+    state = lookup.get(bytes(procfile(bat + "/status", 64).read()).strip(), "unknown")
+    if state == "discharging" and percent <= 5:
+        state = "CRITICAL!"
+    METRICS.record("battery.percent", percent)
+    return f"Bat: {percent}% ({state})", batterylevel(percent, state)
+
+
+def arc_linux(storage):
+    """
+    Report the hit ratio of the ZFS ARC on Linux.
+
+    Argument:
+        storage: A dict from the previous run or an empty dict.
+            This dict will be *modified* by this function.
+
+    Returns:
+        A string to display.
+    """
+    try:
+        # memory_linux also reads arcstats, at the same time, so this item
+        # has its own buffer.
+        if "arcstats" not in storage:
+            storage["arcstats"] = ProcFile("/proc/spl/kstat/zfs/arcstats", 16384)
+        data = storage["arcstats"].read()
+    except FileNotFoundError:  # No ZFS
+        return "ARC: n/a"
+    stats = dict(ARCSTAT.findall(data))
+    return arcratio(storage, int(stats[b"hits"]), int(stats[b"misses"]))
+
+
+def disk_linux(storage):
+    """
+    Report the read and write throughput of the disks on Linux.
+
+    Argument:
+        storage: A dict from the previous run or an empty dict.
+            This dict will be *modified* by this function.
+
+    Returns:
+        A string to display.
+    """
+    names, reads, writes = [], array("Q"), array("Q")
+    for name, rd, wr in DISKSTATS.findall(procfile("/proc/diskstats", 16384).read()):
+        name = name.decode()
+        # Only whole disks are listed in /sys/block.
+        if name.startswith(("loop", "ram", "zram")) or not os.path.exists(
+            "/sys/block/" + name
+        ):
+            continue
+        names.append(name)
+        reads.append(512 * int(rd))  # sectors of 512 bytes
+        writes.append(512 * int(wr))
+    return diskrates(storage, names, reads, writes)
 
 
 def date():
     """Return the date as a string."""
-    return time.strftime("%a %Y-%m-%d %H:%M:%S")
+    # Without arguments, strftime and localtime use time(3). That can lag
+    # a few ms behind time.time(), which is used for scheduling the items.
+    return time.strftime("%a %Y-%m-%d %H:%M:%S", time.localtime(time.time()))
 
 
 if __name__ == "__main__":
@@ -5,18 +5,18 @@
 # Copyright © 2013-2017 R.F. Smith <rsmith@xs4all.nl>.
 # SPDX-License-Identifier: MIT
 # Created: 2013-11-16T18:41:21+01:00
-# Last modified: 2022-01-11T21:06:35+0100
+# Last modified: 2026-10-17T12:00:00+0200
 """Convert video files to H.264/AAC streams in an MP4 container."""
 
 from functools import partial
 import argparse
-import concurrent.futures as cf
 import logging
 import os
-import subprocess as sp
 import sys
 
-__version__ = "2022.01.11"
+import vidlib
+
+__version__ = "2026.10.17"
 
 
 def main():
@@ -24,17 +24,27 @@ def main():
     Entry point for vid2mp4.
     """
     args = setup()
-    starter = partial(runencoder, crf=args.crf, preset=args.preset)
-    with cf.ThreadPoolExecutor(max_workers=os.cpu_count()) as tp:
-        fl = [tp.submit(starter, t) for t in args.files]
-        for fut in cf.as_completed(fl):
-            fn, rv = fut.result()
-            if rv == 0:
-                logging.info(f'finished "{fn}"')
-            elif rv < 0:
-                logging.warning(f'file "{fn}" has unknown extension, ignoring it.')
-            else:
-                logging.error(f"conversion of {fn} failed, return code {rv}")
+    memory = vidlib.availmem()
+    jobs, threads = vidlib.budget(len(args.files), os.cpu_count(), memory, args.memory)
+    logging.info(f"running {jobs} conversion(s) with {threads} threads each")
+    starter = partial(
+        runencoder,
+        crf=args.crf,
+        preset=args.preset,
+        threads=threads,
+        progress=vidlib.Progress(args.interval, args.metrics),
+        manifest=vidlib.Manifest(args.force),
+    )
+    failed = False
+    for fn, rv in vidlib.batch(starter, args.files, jobs):
+        failed = failed or rv != 0
+        if rv == 0:
+            logging.info(f'finished "{fn}"')
+        elif rv < 0:
+            logging.warning(f'file "{fn}" has unknown extension, ignoring it.')
+        else:
+            logging.error(f'conversion of "{fn}" failed, return code {rv}')
+    return 1 if failed else 0
 
 
 def setup():
@@ -58,6 +68,30 @@ def setup():
         ],
         help="preset (default medium) slower is smaller file",
     )
+    parser.add_argument(
+        "-m",
+        "--memory",
+        type=int,
+        default=vidlib.PROFILES["mp4"]["memory"],
+        help="memory in MiB needed per conversion (default %(default)s)",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="also convert files that have been converted before",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="seconds between progress reports (default 10, 0 disables)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="file to append progress reports to as JSON lines",
+    )
     parser.add_argument(
         "--log",
         default="warning",
@@ -75,17 +109,12 @@ def setup():
     )
     logging.debug(f"command line arguments = {sys.argv}")
     logging.debug(f"parsed arguments = {args}")
-    # Check for required programs.
-    try:
-        sp.run(["ffmpeg"], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-        logging.debug("found “ffmpeg”")
-    except FileNotFoundError:
-        logging.error("the “ffmpeg” program cannot be found")
+    if not vidlib.check("mp4"):
         sys.exit(1)
     return args
 
 
-def runencoder(fname, crf, preset):
+def runencoder(fname, crf, preset, threads, progress, manifest):
     """
     Convert a video file to H.264/AAC streams in an MP4 container.
 
@@ -93,53 +122,20 @@ def runencoder(fname, crf, preset):
         fname: Name of the file to convert.
         crf: Constant rate factor. See ffmpeg docs.
         preset: Encoding preset. See ffmpeg docs.
+        threads: Number of threads that ffmpeg may use.
+        progress: vidlib.Progress instance to run ffmpeg.
+        manifest: vidlib.Manifest instance to record finished conversions.
 
     Returns:
-        (fname, return value)
+        The return code, or -1 if the file has an unknown extension.
     """
-    basename, ext = os.path.splitext(fname)
-    known = [
-        ".mp4",
-        ".avi",
-        ".wmv",
-        ".flv",
-        ".mpg",
-        ".mpeg",
-        ".mov",
-        ".ogv",
-        ".mkv",
-        ".webm",
-        ".gif",
-    ]
-    if ext.lower() not in known:
-        return fname, -1
-    if ext.lower() == ".mp4":
-        ofn = basename + "_mod.mp4"
-    else:
-        ofn = basename + ".mp4"
-    args = [
-        "ffmpeg",
-        "-i",
-        fname,
-        "-c:v",
-        "libx264",
-        "-crf",
-        str(crf),
-        "-preset",
-        preset,
-        "-flags",
-        "+mv4+aic",
-        "-c:a",
-        "aac",
-        "-sn",
-        "-y",
-        ofn,
-    ]
-    logging.debug(" ".join(args))
-    logging.info(f'starting conversion of "{fname}".')
-    cp = sp.run(args, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-    return fname, cp.returncode
+    if os.path.splitext(fname)[1].lower() not in vidlib.VIDEOEXT:
+        return -1
+    args = ["ffmpeg", "-threads", str(threads), "-i", fname]
+    args += vidlib.encoderargs("mp4", 1, threads, crf=crf, preset=preset)
+    args += ["-sn", "-f", "mp4", "-y", vidlib.outputname(fname, "mp4")]
+    return vidlib.convert(fname, [args], progress, manifest)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
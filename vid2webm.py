@@ -5,22 +5,42 @@
 # Copyright © 2018 R.F. Smith <rsmith@xs4all.nl>.
 # SPDX-License-Identifier: MIT
 # Created: 2018-12-16T22:45:15+0100
-# Last modified: 2023-02-25T17:05:53+0100
+# Last modified: 2026-10-17T12:00:00+0200
 """
-Convert videos to webm files, using 2-pass constrained rate VP9
-encoding for video and libvorbis for audio.
+Convert videos to webm files, using 2-pass VP9 encoding for video and
+libvorbis for audio. By default constrained rate quality is used; the
+--profile option selects another of the VP9 profiles from vidlib.
+
+With the --chunks option, the video is split into segments at key frames.
+These segments are encoded concurrently and then joined, after which the audio
+is encoded from the original.
+
+Several files are converted concurrently, each with its share of the threads.
+With the --pipeline option, the first pass of the next file runs while the
+second pass of the previous one is encoding.
+
+With the --tune option, short trial encodes determine the fastest settings
+that keep the quality. These are remembered per resolution and thread count.
+
+With the --target option, the highest CRF for which some parts of the video
+reach the target SSIM or PSNR is searched, and used in constant quality mode.
 """
 
-from datetime import datetime
+from functools import partial
 import argparse
+import concurrent.futures as cf
 import logging
-import math
 import os
 import re
-import subprocess as sp
 import sys
 
-__version__ = "2022.12.11"
+import vidlib
+
+__version__ = "2026.10.17"
+
+
+# The profiles in vidlib that produce webm files.
+PROFILES = [k for k, v in vidlib.PROFILES.items() if v["format"] == "webm"]
 
 
 def main(argv):
@@ -33,6 +53,12 @@ def main(argv):
         help="logging level (defaults to 'info')",
     )
     parser.add_argument("-v", "--version", action="version", version=__version__)
+    parser.add_argument(
+        "--profile",
+        default="crq",
+        choices=PROFILES,
+        help="encoding profile (default: crq)",
+    )
     parser.add_argument(
         "-s",
         "--start",
@@ -40,6 +66,59 @@ def main(argv):
         default=None,
         help="time (hh:mm:ss) at which to start encoding",
     )
+    parser.add_argument(
+        "-n",
+        "--chunks",
+        type=int,
+        default=1,
+        help="number of segments to encode concurrently (default: 1)",
+    )
+    parser.add_argument(
+        "-p",
+        "--pipeline",
+        action="store_true",
+        help="overlap the first pass of a file with the second pass of another",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        help="number of files to convert concurrently (default: based on resolution)",
+    )
+    parser.add_argument(
+        "--tune",
+        action="store_true",
+        help="find the fastest encoder settings with trial encodes",
+    )
+    parser.add_argument(
+        "--target",
+        type=float,
+        help="search the highest CRF that reaches this quality score",
+    )
+    parser.add_argument(
+        "--metric",
+        default="ssim",
+        choices=["ssim", "psnr"],
+        help="quality metric for --target (default: ssim)",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="also convert files that have been converted before",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="seconds between progress reports (default: 10, 0 disables)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="file to append progress reports to as JSON lines",
+    )
     parser.add_argument(
         "-d", "--dummy", action="store_true", help="print commands but do not run them"
     )
@@ -53,101 +132,228 @@ def main(argv):
     )
     logging.debug(f"command line arguments = {argv}")
     logging.debug(f"parsed arguments = {args}")
-    if not check_ffmpeg():
+    if not vidlib.check(args.profile):
         return 1
-    for fn in args.files:
-        logging.info(f"processing '{fn}'.")
-        starttime = datetime.now()
-        startstr = str(starttime)[:-7]
-        tc = get_tc(fn)
-        logging.info(f"started at {startstr}.")
-        a1 = mkargs(
-            fn,
-            1,
-            tc,
-            start=args.start,
+    logging.info(f"using profile {args.profile}")
+    widths = {fn: vidlib.probe(fn).get("width") or 0 for fn in args.files}
+    cpus = os.cpu_count()
+    if args.jobs:
+        jobs = min(args.jobs, len(args.files))
+        threads = max(1, cpus // jobs)
+    else:
+        useful = vidlib.usefulthreads(args.profile, max(widths.values()))
+        memory = vidlib.PROFILES[args.profile]["memory"]
+        jobs, threads = vidlib.budget(
+            len(args.files), cpus, vidlib.availmem(), memory, useful
+        )
+    logging.info(f"converting {jobs} file(s) concurrently, {threads} threads each")
+    pipelined = args.pipeline and args.chunks == 1 and not args.dummy
+    tunings = {}
+    if args.tune and args.chunks > 1:
+        logging.warning("--tune cannot be used with --chunks; ignoring it")
+    elif args.tune and not args.dummy:
+        tthreads = pipethreads(threads)[1] if pipelined else threads
+        tunings = {fn: vidlib.tune(fn, args.profile, tthreads) for fn in args.files}
+    if args.target and not args.dummy:
+        for fn in args.files:
+            crf = vidlib.crfsearch(
+                fn, args.profile, args.target, args.metric, tuning=tunings.get(fn)
+            )
+            tunings[fn] = dict(tunings.get(fn) or {}, **(crf or {}))
+    progress = vidlib.Progress(args.interval, args.metrics)
+    manifest = vidlib.Manifest(args.force)
+    if pipelined:
+        failures = pipeline(
+            args.files,
+            widths,
+            jobs,
+            threads,
+            progress,
+            manifest,
+            args.profile,
+            args.start,
+            tunings,
         )
-        a2 = mkargs(
+        return 1 if failures else 0
+    starter = partial(
+        convert,
+        widths=widths,
+        threads=threads,
+        progress=progress,
+        manifest=manifest,
+        profile=args.profile,
+        chunks=args.chunks,
+        start=args.start,
+        dummy=args.dummy,
+        tunings=tunings,
+    )
+    failed = False
+    for fn, rv in vidlib.batch(starter, args.files, jobs):
+        if rv:
+            logging.error(f"conversion of '{fn}' failed, return code {rv}")
+            failed = True
+    return 1 if failed else 0
+
+
+def convert(
+    fn,
+    widths,
+    threads,
+    progress,
+    manifest,
+    profile,
+    chunks=1,
+    start=None,
+    dummy=False,
+    tunings=None,
+):
+    """
+    Convert one file.
+
+    Arguments:
+        fn: String containing the path of the input file
+        widths: Dict of the width of the video per file.
+        threads: Number of threads that the encoder(s) may use.
+        progress: vidlib.Progress instance to run ffmpeg.
+        manifest: vidlib.Manifest instance to record finished conversions.
+        profile: Name of the profile in vidlib.PROFILES.
+        chunks: Number of segments to encode concurrently.
+        start: Optional string containing the start time for the conversion.
+        dummy: Only print the commands instead of running them.
+        tunings: Optional dict of the tuned settings and CRF per file.
+
+    Returns:
+        The return code of the failing step, or 0.
+    """
+    logging.info(f"processing '{fn}'.")
+    tc = vidlib.tile_cols(widths[fn], max(1, threads // chunks))
+    tuning = (tunings or {}).get(fn)
+    if tuning:
+        tc = tuning.get("-tile-columns", tc)
+    logging.info(f"using {tc} tile columns for '{fn}'")
+    passes = [
+        mkargs(fn, npass, tc, start, threads, profile, tuning) for npass in (1, 2)
+    ]
+    run = None
+    if chunks > 1:
+        run = partial(
+            vidlib.encodechunks,
             fn,
-            2,
-            tc,
-            start=args.start,
+            segmentargs=partial(mkchunkargs, fn, tc, profile, tuning=tuning),
+            nchunks=chunks,
+            threads=threads,
+            progress=progress,
+            name=profile,
+            start=start,
         )
-        if not args.dummy:
-            origbytes, newbytes = encode(a1, a2)
-        else:
-            logging.basicConfig(level="INFO")
-            logging.info("first pass: " + " ".join(a1))
-            logging.info("second pass: " + " ".join(a2))
-            continue
-        stoptime = datetime.now()
-        stopstr = str(stoptime)[:-7]
-        logging.info(f"ended at {stopstr}.")
-        runtime = stoptime - starttime
-        runstr = str(runtime)[:-7]
-        logging.info(f"total running time {runstr}.")
-        encspeed = origbytes / (runtime.seconds * 1000)
-        logging.info(f"average input encoding speed {encspeed:.2f} kB/s.")
-
-
-def check_ffmpeg():
-    """Check the minumum version requirement of ffmpeg, and that it is built with
-    the needed drivers enabled."""
-    args = ["ffmpeg", "-version"]
-    try:
-        proc = sp.run(args, text=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
-    except FileNotFoundError:
-        logging.error("ffmpeg not found")
-        return False
-    verre = r"ffmpeg version (\d+)\.(\d+)(?:\.(\d+))? Copyright"
-    major, minor, patch, *rest = re.findall(verre, proc.stdout)[0]
-    logging.info(f"found ffmpeg {major}.{minor}.{patch}")
-    if int(major) < 3 and int(minor) < 3:
-        logging.error(f"ffmpeg 3.3 is required; found {major}.{minor}.{patch}")
-        return False
-    if not re.search(r"enable-libvpx", proc.stdout):
-        logging.error("ffmpeg is not built with VP9 video support.")
-        return False
-    if not re.search(r"enable-libvorbis", proc.stdout):
-        logging.error("ffmpeg is not built with Vorbis audio support.")
-        return False
-    return True
-
-
-def reporttime(p, dt):
+    return vidlib.convert(fn, passes, progress, manifest, dummy=dummy, run=run)
+
+
+def pipeline(
+    files, widths, jobs, threads, progress, manifest, profile, start=None, tunings=None
+):
     """
-    Report the amount of time passed between start and end.
+    Convert files in a two-stage pipeline.
+
+    The first pass is a lot faster than the second. So it gets a third of
+    the threads, and runs for the next files while the second pass for the
+    earlier files is running.
 
     Arguments:
-        p: number of the pass.
-        dt: datetime.timedelta instance.
+        files: List of the paths of the input files.
+        widths: Dict of the width of the video per file.
+        jobs: Number of files to run concurrently in each stage.
+        threads: Number of threads per job, for both stages together.
+        progress: vidlib.Progress instance to run ffmpeg.
+        manifest: vidlib.Manifest instance to record finished conversions.
+        profile: Name of the profile in vidlib.PROFILES.
+        start: Optional string containing the start time for the conversion.
+        tunings: Optional dict of the tuned settings and CRF per file. The
+            first pass only uses the CRF.
+
+    Returns:
+        A dict of the return code per file that failed.
     """
-    s = str(dt)[:-7]
-    logging.info(f"pass {p} took {s}.")
+    t1, t2 = pipethreads(threads)
+    logging.info(f"using {t1} threads for pass 1 and {t2} threads for pass 2")
+    firsts, seconds, failures = {}, {}, {}
+    stage1 = cf.ThreadPoolExecutor(max_workers=jobs)
+    stage2 = cf.ThreadPoolExecutor(max_workers=jobs)
+    with stage1, stage2:
+        for fn in sorted(files, key=vidlib.filesize, reverse=True):
+            tc = vidlib.tile_cols(widths[fn], t2)
+            tuning = (tunings or {}).get(fn)
+            tc = (tuning or {}).get("-tile-columns", tc)
+            a2 = mkargs(fn, 2, tc, start, t2, profile, tuning)
+            outname, params = a2[-1], vidlib.paramhash(a2)
+            if manifest.uptodate(fn, outname, params):
+                logging.info(f"'{outname}' is up to date.")
+                continue
+            a2[-1] = vidlib.partname(outname)
+            rate = {k: v for k, v in (tuning or {}).items() if k in ("-crf", "-b:v")}
+            a1 = mkargs(fn, 1, tc, start, t1, profile, rate)
+            entry = manifest.start(fn, outname, params)
+            fut = stage1.submit(vidlib.runpass, f"pass 1 of '{fn}'", a1, progress)
+            firsts[fut] = (fn, a2, outname, entry)
+        pending = set(firsts)
+        while pending:
+            done, pending = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+            for fut in done:
+                fn, a2, outname, entry = firsts.get(fut) or seconds[fut]
+                try:
+                    rv = fut.result()
+                except Exception as e:
+                    logging.error(f"converting '{fn}' failed: {e}")
+                    rv = -1
+                if rv or fut in seconds:
+                    vidlib.removepasslog(a2)
+                if rv:
+                    logging.error(f"conversion of '{fn}' failed, return code {rv}")
+                    failures[fn] = rv
+                    manifest.fail(outname, entry)
+                    continue
+                if fut in firsts:
+                    label = f"pass 2 of '{fn}'"
+                    fut2 = stage2.submit(vidlib.runpass, label, a2, progress)
+                    seconds[fut2] = firsts[fut]
+                    pending.add(fut2)
+                    continue
+                manifest.done(outname, entry)
+                origsize = vidlib.filesize(fn)
+                if origsize:
+                    percentage = int(100 * vidlib.filesize(outname) / origsize)
+                    logging.info(
+                        f"the size of '{outname}' is {percentage}% of the size of '{fn}'."
+                    )
+    return failures
 
 
-def get_tc(name):
-    """Determine the amount of tile columns to use."""
-    args = ["ffprobe", "-hide_banner", "-select_streams", "v", "-show_streams", name]
-    proc = sp.run(args, text=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
-    lines = proc.stdout.splitlines()
-    d = {}
-    for ln in lines:
-        if '=' in ln:
-            key, value = ln.strip().split("=")
-            d[key] = value
-    width = d["width"]
-    return math.floor(math.log2(math.ceil(float(width) / 64.0)))
+def pipethreads(threads):
+    """
+    Divide the threads of a job between the stages of the pipeline.
+
+    Returns:
+        A 2-tuple of the threads for the first and the second pass.
+    """
+    t1 = max(1, threads // 3)
+    return t1, max(1, threads - t1)
 
 
-def mkargs(fn, npass, tile_columns, start=None):
-    """Create argument list for constrained quality VP9/vorbis encoding.
+def mkargs(
+    fn, npass, tile_columns, start=None, threads=None, profile="crq", tuning=None
+):
+    """Create argument list for VP9/vorbis encoding.
 
     Arguments:
         fn: String containing the path of the input file
         npass: Number of the pass. Must be 1 or 2.
+        tile_columns: number of tile columns.
         start: Optional string containing the start time for the conversion.
             Must be in the format HH:MM:SS, where H, M and S are digits.
+        threads: Optional number of threads. Defaults to the number of CPUs.
+        profile: Name of the profile in vidlib.PROFILES. Defaults to “crq”.
+        tuning: Optional dict of tuned settings from vidlib.tune or
+            vidlib.crfsearch.
 
     Returns:
         A list of strings suitable for calling a subprocess.
@@ -156,8 +362,7 @@ def mkargs(fn, npass, tile_columns, start=None):
         raise ValueError("npass must be 1 or 2")
     if start and not re.search(r"\d{2}:\d{2}:\d{2}", start):
         raise ValueError("starting time must be in the format HH:MM:SS")
-    numthreads = str(os.cpu_count())
-    basename, ext = fn.rsplit(".", 1)
+    basename = os.path.splitext(fn)[0]
     args = [
         "ffmpeg",
         "-loglevel",
@@ -170,90 +375,59 @@ def mkargs(fn, npass, tile_columns, start=None):
     if start:
         args += ["-ss", start]
     args += ["-i", fn, "-passlogfile", basename]
-    speed = "2"
-    if npass == 1:
-        logging.info(f"using {numthreads} threads")
-        logging.info(f"using {tile_columns} tile columns")
-        speed = "4"
-    args += [
-        "-c:v",
-        "libvpx-vp9",
-        "-row-mt",
-        "1",
-        "-threads",
-        numthreads,
-        "-pass",
-        str(npass),
-        "-b:v",
-        "1400k",
-        "-crf",
-        "33",
-        "-g",
-        "250",
-        "-speed",
-        speed,
-        "-tile-columns",
-        str(tile_columns),
-    ]
-    if npass == 2:
-        args += ["-auto-alt-ref", "1", "-lag-in-frames", "25"]
-    args += ["-sn"]
-    if npass == 1:
-        args += ["-an"]
-    elif npass == 2:
-        args += ["-c:a", "libvorbis", "-q:a", "3"]
-    args += ["-f", "webm", "-map", "0:v", "-map", "0:a"]
-    if npass == 1:
-        outname = "/dev/null"
-    else:
-        if ext.lower() == "webm":
-            outname = basename + "_mod.webm"
-        else:
-            outname = basename + ".webm"
+    numthreads = threads or os.cpu_count()
+    args += vidlib.encoderargs(profile, npass, numthreads, tile_columns, tuning=tuning)
+    args += ["-sn", "-f", "webm", "-map", "0:v", "-map", "0:a?"]
+    outname = "/dev/null" if npass == 1 else vidlib.outputname(fn, profile)
     args += ["-y", outname]
     return args
 
 
-def encode(args1, args2):
-    """
-    Run the encoding subprocesses.
+def mkchunkargs(
+    fn, tile_columns, profile, npass, start, end, threads, passlog, outname, tuning=None
+):
+    """Create argument list for VP9 encoding of one segment of the video.
 
     Arguments:
-        args1: Commands to run the first encoding step as a subprocess.
-        args2: Commands to run the second encoding step as a subprocess.
+        fn: String containing the path of the input file
+        tile_columns: number of tile columns.
+        profile: Name of the profile in vidlib.PROFILES.
+        npass: Number of the pass. Must be 1 or 2.
+        start: Start of the segment in seconds.
+        end: End of the segment in seconds.
+        threads: Number of threads that the encoder may use.
+        passlog: Prefix for the name of the pass log file.
+        outname: Name of the file for the encoded segment.
+        tuning: Optional dict of tuned settings from vidlib.tune or
+            vidlib.crfsearch.
 
-    Return values:
-        A 2-tuple of the original movie size in bytes and the encoded movie size in bytes.
+    Returns:
+        A list of strings suitable for calling a subprocess.
     """
-    oidx = args2.index("-i") + 1
-    origsize = os.path.getsize(args2[oidx])
-    logging.info("running pass 1...")
-    logging.debug("pass 1: {}".format(" ".join(args1)))
-    start = datetime.utcnow()
-    proc = sp.run(args1, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-    end = datetime.utcnow()
-    if proc.returncode:
-        logging.error(f"pass 1 returned {proc.returncode}.")
-        return origsize, 0
-    else:
-        dt = end - start
-        reporttime(1, dt)
-    logging.info("running pass 2...")
-    logging.debug("pass 2: {}".format(" ".join(args2)))
-    start = datetime.utcnow()
-    proc = sp.run(args2, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-    end = datetime.utcnow()
-    if proc.returncode:
-        logging.error(f"pass 2 returned {proc.returncode}.")
-    else:
-        dt = end - start
-        reporttime(2, dt)
-    newsize = os.path.getsize(args2[-1])
-    percentage = int(100 * newsize / origsize)
-    ifn, ofn = args2[oidx], args2[-1]
-    logging.info(f"the size of '{ofn}' is {percentage}% of the size of '{ifn}'.")
-    return origsize, newsize  # both in bytes.
+    args = [
+        "ffmpeg",
+        "-loglevel",
+        "quiet",
+        "-probesize",
+        "1G",
+        "-analyzeduration",
+        "1G",
+        "-ss",
+        f"{start:.6f}",
+        "-i",
+        fn,
+        "-t",
+        f"{end - start:.6f}",
+        "-passlogfile",
+        passlog,
+    ]
+    args += vidlib.encoderargs(
+        profile, npass, threads, tile_columns, audio=False, tuning=tuning
+    )
+    args += ["-sn", "-f", "webm", "-map", "0:v:0"]
+    args += ["-y", outname if npass == 2 else "/dev/null"]
+    return args
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
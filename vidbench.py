@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# file: vidbench.py
+# vim:fileencoding=utf-8:ft=python
+#
+# Copyright © 2026 R.F. Smith <rsmith@xs4all.nl>.
+# SPDX-License-Identifier: MIT
+# Created: 2026-10-17T12:00:00+0200
+# Last modified: 2026-10-17T12:00:00+0200
+"""
+Benchmark the video converters on synthetic clips.
+
+The clips are generated by ffmpeg's lavfi sources, so no network or real media
+are needed. Every clip is converted with the commands that vid2webm.py,
+dvd2webm.py and vid2mp4.py would use, for every combination of the given
+settings. The wall clock time, frame rate, output size and CPU utilisation of
+each conversion are written to a CSV file.
+"""
+
+from itertools import product
+import argparse
+import csv
+import logging
+import os
+import resource
+import subprocess as sp
+import sys
+import time
+
+import dvd2webm
+import vid2mp4
+import vid2webm
+import vidlib
+
+__version__ = "2026.10.17"
+SIZES = {"480p": "854x480", "720p": "1280x720", "1080p": "1920x1080"}
+SOURCES = ("testsrc2", "mandelbrot")
+ENCODERS = ("vid2webm", "dvd2webm", "vid2mp4")
+RATE = 25
+FIELDS = (
+    "encoder",
+    "source",
+    "size",
+    "threads",
+    "tile_columns",
+    "row_mt",
+    "preset",
+    "returncode",
+    "wall",
+    "fps",
+    "bytes",
+    "cpu",
+    "utilisation",
+)
+
+
+class Scratch(vidlib.Manifest):
+    """
+    Manifest that considers nothing up to date and records nothing, so a
+    benchmark neither skips conversions nor leaves a manifest behind.
+    """
+
+    def __init__(self):
+        super().__init__(force=True)
+
+    def update(self, outpath, entry):
+        pass
+
+
+def main(argv):
+    """Entry point for vidbench.py."""
+    cpus = os.cpu_count()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--log",
+        default="info",
+        choices=["debug", "info", "warning", "error"],
+        help="logging level (defaults to 'info')",
+    )
+    parser.add_argument("-v", "--version", action="version", version=__version__)
+    parser.add_argument(
+        "-o", "--output", default="vidbench.csv", help="CSV file (default vidbench.csv)"
+    )
+    parser.add_argument(
+        "-w",
+        "--workdir",
+        default="vidbench",
+        help="directory for the clips and the encoded files (default vidbench)",
+    )
+    parser.add_argument(
+        "-l",
+        "--length",
+        type=float,
+        default=5,
+        help="length of the clips in seconds (default 5)",
+    )
+    parser.add_argument(
+        "-e",
+        "--encoders",
+        default=",".join(ENCODERS),
+        help=f"comma separated encoders (default {','.join(ENCODERS)})",
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        default=",".join(SIZES),
+        help=f"comma separated sizes (default {','.join(SIZES)})",
+    )
+    parser.add_argument(
+        "--sources",
+        default=",".join(SOURCES),
+        help=f"comma separated lavfi sources (default {','.join(SOURCES)})",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        default=f"1,{cpus}",
+        help=f"comma separated numbers of threads (default 1,{cpus})",
+    )
+    parser.add_argument(
+        "--tiles",
+        default="0,2",
+        help="comma separated tile columns for VP9 (default 0,2)",
+    )
+    parser.add_argument(
+        "--row-mt",
+        default="1",
+        help="comma separated row-mt settings for VP9 (default 1)",
+    )
+    parser.add_argument(
+        "-p",
+        "--presets",
+        default="medium",
+        help="comma separated x264 presets (default medium)",
+    )
+    parser.add_argument(
+        "-d", "--dummy", action="store_true", help="print commands but do not run them"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=getattr(logging, args.log.upper(), None),
+        format="%(levelname)s: %(message)s",
+    )
+    logging.debug(f"command line arguments = {argv}")
+    logging.debug(f"parsed arguments = {args}")
+    encoders = args.encoders.split(",")
+    for enc in encoders:
+        if enc not in ENCODERS:
+            parser.error(f"unknown encoder '{enc}'")
+        if not vidlib.check("mp4" if enc == "vid2mp4" else "crq"):
+            return 1
+    for size in args.sizes.split(","):
+        if size not in SIZES:
+            parser.error(f"unknown size '{size}'")
+    grid = {
+        "threads": [int(t) for t in args.threads.split(",")],
+        "tile_columns": [int(t) for t in args.tiles.split(",")],
+        "row_mt": args.row_mt.split(","),
+        "preset": args.presets.split(","),
+    }
+    os.makedirs(args.workdir, exist_ok=True)
+    clips = [
+        (source, size, mkclip(args.workdir, source, size, args.length, args.dummy))
+        for source, size in product(args.sources.split(","), args.sizes.split(","))
+    ]
+    frames = int(args.length * RATE)
+    with open(args.output, "w", newline="") as out:
+        writer = csv.DictWriter(out, FIELDS)
+        writer.writeheader()
+        for (source, size, clip), enc in product(clips, encoders):
+            for settings in configurations(enc, grid):
+                row = bench(enc, clip, settings, frames, args.dummy)
+                if row is None:
+                    continue
+                row.update(encoder=enc, source=source, size=size, **settings)
+                logging.info(
+                    f"{enc} {source} {size} {settings}: {row['wall']:.2f} s, "
+                    f"{row['fps']:.1f} fps, {row['bytes']} bytes, "
+                    f"{row['utilisation']:.0f}% CPU"
+                )
+                writer.writerow(row)
+                out.flush()
+    return 0
+
+
+def mkclip(workdir, source, size, length, dummy=False):
+    """
+    Generate a test clip, unless it already exists.
+
+    The video is losslessly encoded with FFV1, so the quality of the clip
+    does not depend on the encoders that ffmpeg is built with.
+
+    Arguments:
+        workdir: Directory to write the clip to.
+        source: Name of the lavfi video source.
+        size: Key in SIZES.
+        length: Length of the clip in seconds.
+        dummy: Only print the command instead of running it.
+
+    Returns:
+        The path of the clip.
+    """
+    path = os.path.join(workdir, f"{source}-{size}-{length:g}s.mkv")
+    if os.path.exists(path):
+        return path
+    args = ["ffmpeg", "-loglevel", "error", "-f", "lavfi"]
+    args += ["-i", f"{source}=size={SIZES[size]}:rate={RATE}", "-f", "lavfi"]
+    args += ["-i", "sine=frequency=440:sample_rate=48000", "-t", f"{length:g}"]
+    args += ["-c:v", "ffv1", "-c:a", "flac", "-y", path]
+    if dummy:
+        logging.info("clip: " + " ".join(args))
+        return path
+    logging.info(f"generating '{path}'")
+    sp.run(args, check=True)
+    return path
+
+
+def configurations(encoder, grid):
+    """
+    Yield the combinations of the settings in grid that apply to an encoder.
+
+    Arguments:
+        encoder: Name of the encoder in ENCODERS.
+        grid: Dict of lists of values per setting.
+
+    Yields:
+        A dict of settings. Settings that do not apply are empty strings.
+    """
+    if encoder == "vid2mp4":
+        for threads, preset in product(grid["threads"], grid["preset"]):
+            yield {
+                "threads": threads,
+                "tile_columns": "",
+                "row_mt": "",
+                "preset": preset,
+            }
+        return
+    for threads, tc, rmt in product(
+        grid["threads"], grid["tile_columns"], grid["row_mt"]
+    ):
+        yield {"threads": threads, "tile_columns": tc, "row_mt": rmt, "preset": ""}
+
+
+def setoption(args, option, value):
+    """
+    Return a copy of an ffmpeg command with the value of an output option set.
+
+    An option that is not present is added before the output file.
+    """
+    args = list(args)
+    if option in args:
+        args[args.index(option) + 1] = str(value)
+    else:
+        args[-2:-2] = [option, str(value)]
+    return args
+
+
+def webmpasses(encoder, clip, settings):
+    """Return the commands for both passes of a webm conversion of clip."""
+    threads, tc = settings["threads"], settings["tile_columns"]
+    if encoder == "vid2webm":
+        passes = [vid2webm.mkargs(clip, n, tc, threads=threads) for n in (1, 2)]
+    else:
+        passes = [dvd2webm.mkargs(clip, n, tc) for n in (1, 2)]
+        passes = [setoption(a, "-threads", threads) for a in passes]
+    return [setoption(a, "-row-mt", settings["row_mt"]) for a in passes]
+
+
+def measure(func, *args, **kwargs):
+    """
+    Call a function that runs subprocesses, and measure the resources used.
+
+    Returns:
+        A 3-tuple of the return value of func, the wall clock time and the
+        CPU time used by the subprocesses in seconds.
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    rv = func(*args, **kwargs)
+    wall = time.monotonic() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime
+    return rv, wall, cpu
+
+
+def bench(encoder, clip, settings, frames, dummy=False):
+    """
+    Convert a clip with the given settings, and measure it.
+
+    Arguments:
+        encoder: Name of the encoder in ENCODERS.
+        clip: Path of the clip.
+        settings: Dict of settings, from configurations.
+        frames: Number of frames in the clip.
+        dummy: Only print the commands instead of running them.
+
+    Returns:
+        A dict with the measurements, or None for a dummy run.
+    """
+    progress = vidlib.Progress(interval=0)
+    if encoder == "vid2mp4":
+        outname = vidlib.outputname(clip, "mp4")
+        if dummy:
+            logging.info(f"{encoder}: runencoder('{clip}', {settings})")
+            return None
+        rv, wall, cpu = measure(
+            vid2mp4.runencoder,
+            clip,
+            vidlib.PROFILES["mp4"]["defaults"]["crf"],
+            settings["preset"],
+            settings["threads"],
+            progress,
+            Scratch(),
+        )
+    else:
+        passes = webmpasses(encoder, clip, settings)
+        outname = passes[-1][-1]
+        if dummy:
+            for npass, args in enumerate(passes, start=1):
+                logging.info(f"{encoder} pass {npass}: " + " ".join(args))
+            return None
+        rv, wall, cpu = measure(vidlib.runpasses, f"'{clip}'", passes, progress)
+    size = vidlib.filesize(outname)
+    if os.path.exists(outname):
+        os.remove(outname)
+    return {
+        "returncode": rv,
+        "wall": wall,
+        "fps": frames / wall if wall else 0.0,
+        "bytes": size,
+        "cpu": cpu,
+        "utilisation": 100 * cpu / (wall * os.cpu_count()) if wall else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,1327 @@
+# file: vidlib.py
+# vim:fileencoding=utf-8:ft=python
+#
+# Copyright © 2026 R.F. Smith <rsmith@xs4all.nl>.
+# SPDX-License-Identifier: MIT
+# Created: 2026-10-17T12:00:00+0200
+# Last modified: 2026-10-17T12:00:00+0200
+"""
+Encoding engine shared by the video conversion scripts.
+
+This is not a program; it is imported by vid2mkv.py, vid2mp4.py, vid2webm.py
+and dvd2webm.py, so it should be installed in the same directory as those.
+
+The encoder settings are described by the PROFILES. Files are probed, scheduled
+and converted by the same functions for every script.
+The results of ffmpeg -version and ffprobe are cached in CACHEFILE.
+Finished conversions are recorded in a MANIFEST file in the output directory.
+"""
+
+import atexit
+import concurrent.futures as cf
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess as sp
+import tempfile
+import threading
+import time
+
+__version__ = "2026.10.17"
+CACHEFILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "vidlib.json"
+)
+CACHESIZE = 10000
+# Age in seconds after which reading a cache entry updates its time of use.
+CACHETOUCH = 86400
+MANIFEST = ".vidlib-manifest.json"
+# Page counts and ARC size that make up the available memory on FreeBSD.
+FREEBSDMEM = (
+    "vm.stats.vm.v_free_count",
+    "vm.stats.vm.v_inactive_count",
+    "vm.stats.vm.v_laundry_count",
+    "kstat.zfs.misc.arcstats.size",
+)
+# Length in seconds of the parts of a video that tune encodes.
+TUNESECONDS = 4
+# Largest loss of SSIM that tune accepts for a faster setting.
+TUNELOSS = 0.005
+# A setting must be this much faster for tune to prefer it; smaller
+# differences are noise.
+TUNEGAIN = 0.05
+# Range of CRF values that crfsearch considers.
+CRFRANGE = (15, 50)
+# Options that are left out of the parameter hash in the manifest. Apart from
+# -tile-columns they do not change the result. The tile columns do change the
+# VP9 bitstream, but not its quality, and they follow the number of threads
+# per job; otherwise a file would be converted again whenever it is part of a
+# batch of a different size.
+NEUTRAL = ("-threads", "-tile-columns", "-passlogfile", "-progress", "-loglevel")
+# Extensions of the files that the converters accept.
+VIDEOEXT = (
+    ".mp4",
+    ".avi",
+    ".wmv",
+    ".flv",
+    ".mpg",
+    ".mpeg",
+    ".mov",
+    ".ogv",
+    ".mkv",
+    ".webm",
+    ".gif",
+)
+
+# Encoding profiles.
+# The “video” options are used in every pass, the “pass1” and “pass2” options
+# only in that pass of a two-pass encoding. The “audio” options are used in
+# the last pass. Fields like “{crf}” are filled in from the “defaults”, unless
+# another value is given. Profiles with “tiles” use tile columns; a profile
+# with “threads” always uses that number of threads. The “memory” is an
+# estimate of what one conversion needs in MiB. The “requires” are the
+# libraries that ffmpeg must be built with.
+# Settings for VP9 from http://wiki.webmproject.org/ffmpeg/vp9-encoding-guide
+# But using Vorbis instead of Opus.
+_VP9 = {
+    "requires": ("libvpx", "libvorbis"),
+    "format": "webm",
+    "extension": ".webm",
+    "passes": 2,
+    "tiles": True,
+    "memory": 1024,
+    "pass1": ["-speed", "4"],
+    "pass2": ["-speed", "2", "-auto-alt-ref", "1", "-lag-in-frames", "25"],
+    "audio": ["-c:a", "libvorbis", "-q:a", "3"],
+}
+PROFILES = {
+    "vod": dict(
+        _VP9,
+        description="video on demand",
+        video=["-c:v", "libvpx-vp9", "-row-mt", "1", "-b:v", "1000k", "-g", "250"],
+        pass2=["-speed", "1", "-auto-alt-ref", "1", "-lag-in-frames", "25"],
+    ),
+    "crq": dict(
+        _VP9,
+        description="constrained rate quality",
+        video=["-c:v", "libvpx-vp9", "-row-mt", "1", "-b:v", "1400k", "-crf", "33"]
+        + ["-g", "250"],
+    ),
+    "con": dict(
+        _VP9,
+        description="constant quality",
+        video=["-c:v", "libvpx-vp9", "-row-mt", "1", "-b:v", "0", "-crf", "25"]
+        + ["-g", "250"],
+    ),
+    "bq": dict(
+        _VP9,
+        description="best quality",
+        video=["-c:v", "libvpx-vp9", "-b:v", "1000k", "-g", "9999", "-aq-mode", "0"]
+        + ["-tile-columns", "0"],
+        pass2=["-speed", "0", "-auto-alt-ref", "1", "-lag-in-frames", "25"],
+        tiles=False,
+        threads=1,
+    ),
+    "mp4": {
+        "description": "H.264/AAC in an MP4 container",
+        "requires": ("libx264",),
+        "format": "mp4",
+        "extension": ".mp4",
+        "passes": 1,
+        "memory": 1024,
+        "video": ["-c:v", "libx264", "-crf", "{crf}", "-preset", "{preset}"]
+        + ["-flags", "+mv4+aic"],
+        "audio": ["-c:a", "aac"],
+        "defaults": {"crf": 29, "preset": "medium"},
+    },
+    "mkv": {
+        "description": "Theora/Vorbis in a Matroska container",
+        "requires": ("libtheora", "libvorbis"),
+        "format": "matroska",
+        "extension": ".mkv",
+        "passes": 1,
+        "memory": 256,
+        "video": ["-c:v", "libtheora", "-q:v", "{vq}"],
+        "audio": ["-c:a", "libvorbis", "-q:a", "{aq}"],
+        "defaults": {"vq": 6, "aq": 3},
+    },
+}
+
+
+class Cache:
+    """
+    Persistent cache for the output of ffmpeg and ffprobe.
+
+    The entries are stored in a JSON file. When there are more entries than
+    the given size, the least recently used are discarded when saving. The
+    time of use is only refreshed once per CACHETOUCH seconds, so reading
+    entries does not cause the file to be rewritten every time.
+    Several processes can use the same file; when saving, the entries of the
+    file and those in memory are merged.
+
+    Arguments:
+        path (str): Location of the cache file.
+        size (int): Maximum number of entries.
+    """
+
+    def __init__(self, path, size=CACHESIZE):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = self.load()
+        self.dirty = False
+
+    def load(self):
+        """Return the entries from the cache file, or an empty dict."""
+        try:
+            with open(self.path) as cf:
+                return json.load(cf)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        """Return the value for key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            now = time.time()
+            if now - entry["used"] > CACHETOUCH:
+                entry["used"] = now
+                self.dirty = True
+            return entry["value"]
+
+    def put(self, key, value):
+        """Store a value that can be converted to JSON."""
+        with self.lock:
+            self.entries[key] = {"used": time.time(), "value": value}
+            self.dirty = True
+
+    def save(self):
+        """Write the cache file, if anything changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            merged = self.load()
+            for key, entry in self.entries.items():
+                if key not in merged or merged[key]["used"] < entry["used"]:
+                    merged[key] = entry
+            if len(merged) > self.size:
+                keep = sorted(merged, key=lambda k: merged[k]["used"])[-self.size :]
+                merged = {k: merged[k] for k in keep}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmpname = f"{self.path}.{os.getpid()}"
+                with open(tmpname, "w") as cf:
+                    json.dump(merged, cf)
+                os.replace(tmpname, self.path)
+                self.dirty = False
+            except OSError as e:
+                logging.warning(f"cannot save cache: {e}")
+
+
+_cache = None
+
+
+def cache():
+    """Return the Cache, which is saved when the program ends."""
+    global _cache
+    if _cache is None:
+        _cache = Cache(CACHEFILE)
+        atexit.register(_cache.save)
+    return _cache
+
+
+def ffmpeginfo():
+    """
+    Return the output of “ffmpeg -version”, or None if ffmpeg cannot be found.
+
+    The result is cached for the path and modification time of the ffmpeg
+    binary.
+    """
+    path = shutil.which("ffmpeg")
+    if path is None:
+        return None
+    key = f"ffmpeg:{path}:{os.stat(path).st_mtime_ns}"
+    rv = cache().get(key)
+    if rv is None:
+        proc = sp.run([path, "-version"], text=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
+        rv = proc.stdout
+        cache().put(key, rv)
+    return rv
+
+
+def probe(path, keyframes=False):
+    """
+    Return information about a video file.
+
+    The result is cached for the path, size and modification time of the file.
+
+    Arguments:
+        path: Location of the file to query.
+        keyframes: Also find the times of the key frames. This has to read
+            the whole file.
+
+    Returns:
+        A dict with the “duration” and “start_time” of the file in seconds,
+        a list of the “codecs” of the streams and the “width” and “height”
+        of the first video stream, if present. With keyframes, it also
+        contains a sorted list of the times of the “keyframes” of the first
+        video stream in seconds from the start.
+        An empty dict if the file cannot be read.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return {}
+    key = f"file:{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+    info = cache().get(key)
+    if info is None:
+        args = ["ffprobe", "-v", "error", "-of", "json", "-show_entries"]
+        args += ["format=duration,start_time:stream=codec_type,codec_name,width,height"]
+        proc = sp.run(args + [path], text=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
+        try:
+            data = json.loads(proc.stdout)
+        except ValueError:
+            return {}
+        fmt = data.get("format", {})
+        streams = data.get("streams", [])
+        info = {
+            "duration": float(fmt.get("duration", 0)) or None,
+            "start_time": float(fmt.get("start_time", 0)),
+            "codecs": [s.get("codec_name") for s in streams],
+        }
+        video = [s for s in streams if s.get("codec_type") == "video"]
+        if video:
+            info["width"], info["height"] = video[0].get("width"), video[0].get(
+                "height"
+            )
+        cache().put(key, info)
+    if keyframes and "keyframes" not in info:
+        args = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-of", "json"]
+        args += ["-show_entries", "packet=pts_time,flags", path]
+        proc = sp.run(args, text=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
+        packets = json.loads(proc.stdout or "{}").get("packets", [])
+        info["keyframes"] = sorted(
+            float(p["pts_time"]) - info["start_time"]
+            for p in packets
+            if "K" in p.get("flags", "") and "pts_time" in p
+        )
+        cache().put(key, info)
+    return info
+
+
+def duration(path):
+    """
+    Determine the duration of a video file.
+
+    Arguments:
+        path: Location of the file to query.
+
+    Returns:
+        The duration in seconds, or None if it cannot be determined.
+    """
+    return probe(path).get("duration")
+
+
+def seconds(ts):
+    """Convert a time like HH:MM:SS(.sss) or a number of seconds to seconds."""
+    rv = 0.0
+    for part in ts.split(":"):
+        rv = rv * 60 + float(part)
+    return rv
+
+
+def inputlength(args):
+    """
+    Determine how much of the input an ffmpeg command will process.
+
+    This looks at the first input file, and a -ss option before it
+    or a -t option after it.
+
+    Arguments:
+        args: ffmpeg command as a list of strings.
+
+    Returns:
+        The length in seconds, or None if it cannot be determined.
+    """
+    try:
+        idx = args.index("-i")
+    except ValueError:
+        return None
+    length = duration(args[idx + 1])
+    if length is None:
+        return None
+    if "-ss" in args[:idx]:
+        length -= seconds(args[args.index("-ss") + 1])
+    if "-t" in args[idx:]:
+        length = min(length, seconds(args[args.index("-t", idx) + 1]))
+    return length if length > 0 else None
+
+
+def hms(secs):
+    """Format a number of seconds as HH:MM:SS."""
+    if secs is None or secs < 0:
+        return "?"
+    m, s = divmod(int(secs), 60)
+    h, m = divmod(m, 60)
+    return f"{h:02d}:{m:02d}:{s:02d}"
+
+
+def number(value):
+    """Convert a value from a progress report like “24.5” or “1.2x” to a float."""
+    try:
+        return float(value.rstrip("x"))
+    except (AttributeError, ValueError):
+        return None
+
+
+def parseprogress(lines):
+    """
+    Parse the output of ffmpeg's “-progress” option.
+
+    Arguments:
+        lines: Iterable of lines.
+
+    Yields:
+        A dict of key/value strings per progress report.
+    """
+    block = {}
+    for ln in lines:
+        key, sep, value = ln.strip().partition("=")
+        if not sep:
+            continue
+        block[key] = value.strip()
+        if key == "progress":
+            yield block
+            block = {}
+
+
+class Progress:
+    """
+    Run ffmpeg while reporting its progress.
+
+    Arguments:
+        interval (float): Seconds between reports. 0 disables logging them.
+        metrics (str): Optional name of a file to append the reports to as
+            JSON lines.
+    """
+
+    def __init__(self, interval=10, metrics=None):
+        self.interval = interval
+        self.metrics = metrics
+        self.lock = threading.Lock()
+
+    def run(self, args, label, length=None):
+        """
+        Run an ffmpeg command, and report its progress.
+
+        Arguments:
+            args: ffmpeg command as a list of strings.
+            label: Description of the command for the reports.
+            length: Optional length of the input in seconds, to calculate the
+                ETA. Determined from the input if not given.
+
+        Returns:
+            The return code of ffmpeg.
+        """
+        if length is None:
+            length = inputlength(args)
+        args = args[:1] + ["-progress", "pipe:1", "-nostats"] + args[1:]
+        proc = sp.Popen(args, text=True, stdout=sp.PIPE, stderr=sp.DEVNULL)
+        reader = threading.Thread(
+            target=self.read, args=(proc.stdout, label, length), daemon=True
+        )
+        reader.start()
+        rv = proc.wait()
+        reader.join()
+        return rv
+
+    def read(self, stream, label, length):
+        """Read the progress of ffmpeg from stream, and report at intervals."""
+        start = time.monotonic()
+        last = start
+        for block in parseprogress(stream):
+            now = time.monotonic()
+            if now - last < self.interval and block["progress"] != "end":
+                continue
+            last = now
+            self.report(label, block, now - start, length)
+
+    def report(self, label, block, elapsed, length):
+        """Log a progress report, and write it to the metrics file."""
+        pos = number(block.get("out_time_us"))
+        if pos is not None:
+            pos /= 1e6
+        eta = None
+        if length and pos and pos > 0:
+            eta = max(0.0, elapsed * (length - pos) / pos)
+        if self.interval:
+            logging.info(
+                f"{label}: frame {block.get('frame', '?')}, "
+                f"{block.get('fps', '?')} fps, speed {block.get('speed', '?')}, "
+                f"at {hms(pos)}, ETA {hms(eta)}"
+            )
+        if not self.metrics:
+            return
+        record = {
+            "time": time.time(),
+            "label": label,
+            "frame": number(block.get("frame")),
+            "fps": number(block.get("fps")),
+            "speed": number(block.get("speed")),
+            "out_time": pos,
+            "duration": length,
+            "eta": eta,
+            "progress": block.get("progress"),
+        }
+        with self.lock, open(self.metrics, "a") as mf:
+            mf.write(json.dumps(record) + "\n")
+
+
+def identity(path):
+    """Return a dict with the size and modification time of a file, or None."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def paramhash(args):
+    """
+    Return a hash of the options of an ffmpeg command that determine the result.
+
+    Options that only influence speed or logging, the input and the output
+    are left out.
+    """
+    args = args[1:-1]
+    kept = []
+    skip = False
+    for a in args:
+        if skip:
+            skip = False
+        elif a in NEUTRAL or a == "-i":
+            skip = True
+        else:
+            kept.append(a)
+    return hashlib.sha256(" ".join(kept).encode("utf-8")).hexdigest()[:16]
+
+
+def partname(path):
+    """Return the name to write an output file to before it is complete."""
+    base, ext = os.path.splitext(path)
+    return f"{base}.part{ext}"
+
+
+class Manifest:
+    """
+    Record which conversions have been completed, so they can be skipped.
+
+    Each output directory gets a MANIFEST file. For every output file it
+    records the input file, a hash of the parameters, the state of the
+    conversion and the output file.
+
+    Arguments:
+        force (bool): Consider nothing up to date.
+    """
+
+    def __init__(self, force=False):
+        self.force = force
+        self.lock = threading.Lock()
+
+    def load(self, directory):
+        """Return the entries in the manifest of a directory."""
+        try:
+            with open(os.path.join(directory, MANIFEST)) as mf:
+                return json.load(mf)
+        except (OSError, ValueError):
+            return {}
+
+    def update(self, outpath, entry):
+        """Replace the entry for outpath, and save the manifest atomically."""
+        directory, name = os.path.split(os.path.abspath(outpath))
+        path = os.path.join(directory, MANIFEST)
+        with self.lock:
+            entries = self.load(directory)
+            entries[name] = entry
+            tmpname = f"{path}.{os.getpid()}"
+            with open(tmpname, "w") as mf:
+                json.dump(entries, mf, indent=1)
+            os.replace(tmpname, path)
+
+    def uptodate(self, inpath, outpath, params):
+        """
+        Check if outpath was completely made from the current inpath with the
+        same parameters.
+        """
+        if self.force:
+            return False
+        directory, name = os.path.split(os.path.abspath(outpath))
+        with self.lock:
+            entry = self.load(directory).get(name)
+        return (
+            entry is not None
+            and entry["state"] == "done"
+            and entry["input"] == identity(inpath)
+            and entry["params"] == params
+            and entry["output"] == identity(outpath)
+        )
+
+    def start(self, inpath, outpath, params):
+        """Record that a conversion has started."""
+        entry = {
+            "source": os.path.abspath(inpath),
+            "input": identity(inpath),
+            "params": params,
+            "state": "started",
+            "output": None,
+        }
+        self.update(outpath, entry)
+        return entry
+
+    def done(self, outpath, entry):
+        """
+        Move the finished output from its partname into place, and record that
+        the conversion is done.
+        """
+        os.replace(partname(outpath), outpath)
+        entry.update(state="done", output=identity(outpath))
+        self.update(outpath, entry)
+
+    def fail(self, outpath, entry):
+        """Remove the incomplete output, and record that the conversion failed."""
+        part = partname(outpath)
+        if os.path.exists(part):
+            os.remove(part)
+        entry.update(state="failed")
+        self.update(outpath, entry)
+
+
+def audioargs(name, **values):
+    """
+    Return the audio options of a profile.
+
+    Arguments:
+        name: Name of the profile in PROFILES.
+        values: Values for the fields in the options, instead of the defaults.
+
+    Returns:
+        A list of strings.
+    """
+    profile = PROFILES[name]
+    fields = dict(profile.get("defaults", {}), **values)
+    return [a.format(**fields) for a in profile["audio"]]
+
+
+def encoderargs(
+    name, npass, threads, tile_columns=0, audio=True, tuning=None, **values
+):
+    """
+    Create the output options for one pass of a profile.
+
+    Only the last pass of a profile encodes the audio.
+    Options that are in both the profile and the tuning get the value from
+    the tuning. The “-speed” of the tuning is only used in the last pass.
+
+    Arguments:
+        name: Name of the profile in PROFILES.
+        npass: Number of the pass, starting at 1.
+        threads: Number of threads that the encoder may use. A profile can
+            override this.
+        tile_columns: Number of tile columns, for profiles that use them.
+        audio: Encode the audio in the last pass. Otherwise it is left out.
+        tuning: Optional dict of ffmpeg options and values, as made by tune.
+        values: Values for the fields in the options, instead of the defaults.
+
+    Returns:
+        A list of strings.
+    """
+    profile = PROFILES[name]
+    if not 1 <= npass <= profile["passes"]:
+        raise ValueError(f"profile {name} has no pass {npass}")
+    fields = dict(profile.get("defaults", {}), **values)
+    args = profile["video"] + ["-threads", str(profile.get("threads", threads))]
+    if profile["passes"] > 1:
+        args += ["-pass", str(npass)] + profile[f"pass{npass}"]
+    if profile.get("tiles"):
+        args += ["-tile-columns", str(tile_columns)]
+    args = [a.format(**fields) for a in args]
+    for option, value in (tuning or {}).items():
+        if option in args and (option != "-speed" or npass == profile["passes"]):
+            args[args.index(option) + 1] = str(value)
+    if audio and npass == profile["passes"]:
+        return args + audioargs(name, **values)
+    return args + ["-an"]
+
+
+def outputname(path, name):
+    """
+    Return the name of the file to convert path to with a profile.
+
+    An input file that already has the extension of the profile gets “_mod”
+    added to its name.
+    """
+    base, ext = os.path.splitext(path)
+    new = PROFILES[name]["extension"]
+    if ext.lower() == new:
+        return base + "_mod" + new
+    return base + new
+
+
+def check(name):
+    """
+    Check that ffmpeg can be found, is recent enough, and is built with the
+    libraries that a profile needs.
+
+    Arguments:
+        name: Name of the profile in PROFILES.
+
+    Returns:
+        True if the profile can be used, False otherwise.
+    """
+    info = ffmpeginfo()
+    if info is None:
+        logging.error("ffmpeg not found")
+        return False
+    version = re.search(r"ffmpeg version n?(\d+)\.(\d+)", info)
+    if version is None:
+        logging.info("found ffmpeg of unknown version")
+    else:
+        major, minor = int(version[1]), int(version[2])
+        logging.info(f"found ffmpeg {major}.{minor}")
+        if (major, minor) < (3, 3):
+            logging.error(f"ffmpeg 3.3 is required; found {major}.{minor}")
+            return False
+    for lib in PROFILES[name]["requires"]:
+        if f"enable-{lib}" not in info:
+            logging.error(f"ffmpeg is not built with {lib}.")
+            return False
+    return True
+
+
+def tile_cols(width, threads):
+    """
+    Determine the amount of tile columns to use.
+
+    There is no point in having more tile columns than threads.
+
+    Returns:
+        The base 2 logarithm of the number of tile columns, as ffmpeg wants it.
+    """
+    tc = math.floor(math.log2(max(1, math.ceil(float(width) / 64.0))))
+    return max(0, min(tc, math.floor(math.log2(max(1, threads)))))
+
+
+def usefulthreads(name, width):
+    """
+    Determine how many threads one encoder can keep busy.
+
+    A VP9 encoder with row based multithreading keeps about two threads busy
+    per tile column, and a tile column must be at least 256 pixels wide.
+    So small videos cannot use all the cores of a big machine. Other encoders
+    are only limited by the number of files and the memory.
+
+    Arguments:
+        name: Name of the profile in PROFILES.
+        width: Width of the (widest) video in pixels.
+
+    Returns:
+        The number of threads.
+    """
+    profile = PROFILES[name]
+    if "threads" in profile:
+        return profile["threads"]
+    if not profile.get("tiles"):
+        return 1
+    return 2 * 2 ** math.floor(math.log2(max(1, width // 256)))
+
+
+def filesize(path):
+    """Return the size of a file in bytes, or 0 if it cannot be found."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def availmem():
+    """
+    Return the amount of available memory in MiB.
+
+    Like in statusline-i3.py, this includes the memory that the system can
+    reclaim, like the page cache and the ZFS ARC. The number of free pages
+    alone is far too low on a system that has been running for a while.
+    """
+    pagesize = os.sysconf("SC_PAGE_SIZE")
+    try:  # Linux
+        with open("/proc/meminfo") as mf:
+            info = dict(line.split(":", 1) for line in mf)
+        avail = int(info["MemAvailable"].split()[0]) * 1024
+        try:
+            with open("/proc/spl/kstat/zfs/arcstats") as af:
+                avail += int(re.search(r"^size\s+\d+\s+(\d+)", af.read(), re.M)[1])
+        except (OSError, TypeError):
+            pass
+        return avail // 2**20
+    except (OSError, KeyError, ValueError):
+        pass
+    try:  # FreeBSD
+        proc = sp.run(
+            ["sysctl", "-i", *FREEBSDMEM], stdout=sp.PIPE, stderr=sp.DEVNULL, text=True
+        )
+        values = dict(line.split(": ", 1) for line in proc.stdout.splitlines())
+        if proc.returncode == 0 and "vm.stats.vm.v_free_count" in values:
+            pages = sum(int(v) for k, v in values.items() if k.startswith("vm."))
+            arc = int(values.get("kstat.zfs.misc.arcstats.size", 0))
+            return (pages * pagesize + arc) // 2**20
+    except (OSError, ValueError):
+        pass
+    try:
+        pages = os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError):
+        # Not all systems know how much memory is free; assume half.
+        pages = os.sysconf("SC_PHYS_PAGES") // 2
+    return pages * pagesize // 2**20
+
+
+def budget(nfiles, cpus, memory, memperjob, useful=1):
+    """
+    Determine how many conversions to run at the same time, and how many
+    threads each one may use.
+
+    Arguments:
+        nfiles: Number of files to convert.
+        cpus: Number of logical CPUs.
+        memory: Available memory in MiB.
+        memperjob: Memory needed per conversion in MiB.
+        useful: Number of threads that one conversion can keep busy.
+
+    Returns:
+        A 2-tuple of the number of concurrent jobs and threads per job.
+    """
+    jobs = max(1, min(nfiles, cpus // max(1, useful), memory // max(1, memperjob)))
+    return jobs, max(1, cpus // jobs)
+
+
+def batch(func, files, jobs):
+    """
+    Call func for every file, running at most jobs of them at the same time.
+
+    The largest files are started first, so the tail of the batch is short.
+
+    Arguments:
+        func: Function that takes the name of a file.
+        files: List of file names.
+        jobs: Number of concurrent calls.
+
+    Yields:
+        A 2-tuple of the file name and the return value of func, in the order
+        in which they finish.
+    """
+    files = sorted(files, key=filesize, reverse=True)
+    with cf.ThreadPoolExecutor(max_workers=jobs) as tp:
+        fl = {tp.submit(func, fn): fn for fn in files}
+        for fut in cf.as_completed(fl):
+            yield fl[fut], fut.result()
+
+
+def runpass(label, args, progress, length=None):
+    """
+    Run one ffmpeg command, and report how long it took.
+
+    Arguments:
+        label: Description of the command for the reports.
+        args: ffmpeg command as a list of strings.
+        progress: Progress instance to run ffmpeg.
+        length: Optional length of the input in seconds.
+
+    Returns:
+        The return code of ffmpeg.
+    """
+    logging.info(f"running {label}...")
+    logging.debug(f"{label}: " + " ".join(args))
+    start = time.monotonic()
+    rv = progress.run(args, label, length)
+    if rv:
+        logging.error(f"{label} returned {rv}.")
+    else:
+        logging.info(f"{label} took {hms(time.monotonic() - start)}.")
+    return rv
+
+
+def runpasses(label, passes, progress):
+    """
+    Run the passes of an encoding one after another.
+
+    Arguments:
+        label: Description of what is being encoded.
+        passes: List of ffmpeg commands.
+        progress: Progress instance to run ffmpeg.
+
+    Returns:
+        The return code of the failing pass, or 0.
+    """
+    try:
+        for npass, args in enumerate(passes, start=1):
+            plabel = f"pass {npass} of {label}" if len(passes) > 1 else label
+            rv = runpass(plabel, args, progress)
+            if rv:
+                return rv
+        return 0
+    finally:
+        if len(passes) > 1:
+            removepasslog(passes[-1])
+
+
+def removepasslog(args):
+    """Remove the pass log file of an ffmpeg command that has -passlogfile."""
+    if "-passlogfile" not in args:
+        return
+    path = args[args.index("-passlogfile") + 1] + "-0.log"
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def convert(fn, passes, progress, manifest, dummy=False, run=None):
+    """
+    Convert one file, unless the manifest shows that it is up to date.
+
+    The output is written to a temporary name and moved into place when it is
+    complete, so an interrupted conversion is never mistaken for a finished
+    one.
+
+    Arguments:
+        fn: Name of the input file.
+        passes: List of ffmpeg commands for the passes. The last one writes
+            the output file.
+        progress: Progress instance to run ffmpeg.
+        manifest: Manifest instance to record finished conversions.
+        dummy: Only log the commands instead of running them.
+        run: Optional function to call instead of running the passes, like a
+            partial of encodechunks. It gets the name to write the output to
+            and the “dummy” keyword, and returns the return code.
+
+    Returns:
+        The return code of the failing step, or 0.
+    """
+    outname, params = passes[-1][-1], paramhash(passes[-1])
+    if dummy:
+        if run:
+            return run(outname, dummy=True)
+        for npass, args in enumerate(passes, start=1):
+            logging.info(f"pass {npass}: " + " ".join(args))
+        return 0
+    if manifest.uptodate(fn, outname, params):
+        logging.info(f"'{outname}' is up to date.")
+        return 0
+    entry = manifest.start(fn, outname, params)
+    part = partname(outname)
+    start = time.monotonic()
+    if run:
+        rv = run(part, dummy=False)
+    else:
+        rv = runpasses(f"'{fn}'", passes[:-1] + [passes[-1][:-1] + [part]], progress)
+    if rv:
+        manifest.fail(outname, entry)
+        return rv
+    manifest.done(outname, entry)
+    elapsed = time.monotonic() - start
+    origsize, newsize = filesize(fn), filesize(outname)
+    if origsize:
+        percentage = int(100 * newsize / origsize)
+        logging.info(f"the size of '{outname}' is {percentage}% of the size of '{fn}'.")
+    logging.info(f"total running time for '{fn}' {hms(elapsed)}.")
+    encspeed = origsize / (max(elapsed, 1) * 1000)
+    logging.info(f"average input encoding speed {encspeed:.2f} kB/s.")
+    return 0
+
+
+def splitpoints(times, begin, end, n):
+    """
+    Divide a part of a video into at most n segments of roughly equal length.
+
+    Apart from the first, every segment starts at a key frame.
+
+    Arguments:
+        times: Sorted list of the times of the key frames in seconds.
+        begin: Start of the part to divide in seconds.
+        end: End of the part to divide in seconds.
+        n: Number of segments.
+
+    Returns:
+        A list of (start, end) tuples in seconds.
+    """
+    candidates = [t for t in times if begin < t < end]
+    points = [begin]
+    for k in range(1, n):
+        target = begin + k * (end - begin) / n
+        best = min(candidates, key=lambda t: abs(t - target), default=None)
+        if best is not None and best > points[-1]:
+            points.append(best)
+    points.append(end)
+    return list(zip(points, points[1:]))
+
+
+def concatargs(fn, listname, outname, name, start=None, audio="1:a"):
+    """
+    Create argument list to join the encoded segments, and add the audio.
+
+    Arguments:
+        fn: String containing the path of the original input file.
+        listname: Name of the file listing the segments for the concat demuxer.
+        outname: Name of the output file.
+        name: Name of the profile in PROFILES.
+        start: Optional string containing the start time for the conversion.
+        audio: Stream specifier of the audio track to use.
+
+    Returns:
+        A list of strings suitable for calling a subprocess.
+    """
+    args = ["ffmpeg", "-loglevel", "quiet", "-f", "concat", "-safe", "0"]
+    args += ["-i", listname]
+    if start:
+        args += ["-ss", start]
+    args += ["-i", fn, "-map", "0:v", "-map", f"{audio}?", "-c:v", "copy"]
+    args += audioargs(name) + ["-sn", "-f", PROFILES[name]["format"]]
+    return args + ["-y", outname]
+
+
+def encodechunks(
+    fn,
+    outname,
+    segmentargs,
+    nchunks,
+    threads,
+    progress,
+    name,
+    start=None,
+    audio="1:a",
+    dummy=False,
+):
+    """
+    Encode a video in segments that are processed concurrently.
+
+    The segments are split at key frames, so that they can be joined without
+    re-encoding. The threads are divided over the segments.
+
+    Arguments:
+        fn: String containing the path of the input file
+        outname: Name of the output file.
+        segmentargs: Function to create the ffmpeg command for a pass of a
+            segment. It is called with the number of the pass, the start and
+            end of the segment in seconds, the number of threads, the prefix
+            for the pass log file and the name of the output file.
+        nchunks: Number of segments.
+        threads: Number of threads for all segments together.
+        progress: Progress instance to run ffmpeg.
+        name: Name of the profile in PROFILES.
+        start: Optional string containing the start time for the conversion.
+            Must be in the format HH:MM:SS, where H, M and S are digits.
+        audio: Stream specifier of the audio track to use.
+        dummy: Only log the commands instead of running them.
+
+    Returns:
+        The return code of the failing step, 1 if the input cannot be split,
+        or 0.
+    """
+    if start and not re.search(r"\d{2}:\d{2}:\d{2}", start):
+        raise ValueError("starting time must be in the format HH:MM:SS")
+    profile = PROFILES[name]
+    basename = os.path.splitext(fn)[0]
+    info = probe(fn, keyframes=True)
+    duration = info.get("duration")
+    if duration is None:
+        logging.error(f"cannot determine the duration of '{fn}'")
+        return 1
+    begin = seconds(start) if start else 0.0
+    if begin >= duration:
+        logging.error(f"start {start} is past the end of '{fn}' ({duration:.1f} s)")
+        return 1
+    keyframes = info.get("keyframes")
+    if not keyframes:
+        logging.warning(f"no key frames found in '{fn}'; encoding in one segment")
+        keyframes = []
+    segments = splitpoints(keyframes, begin, duration, nchunks)
+    threads = max(1, threads // len(segments))
+    logging.info(f"using {len(segments)} segments with {threads} threads each")
+    jobs, junk = [], []
+    for k, (b, e) in enumerate(segments):
+        passlog = f"{basename}-seg{k:03d}"
+        part = passlog + profile["extension"]
+        passes = [
+            segmentargs(npass, b, e, threads, passlog, part)
+            for npass in range(1, profile["passes"] + 1)
+        ]
+        jobs.append((f"segment {k}", passes))
+        junk += [part, f"{passlog}-0.log"]
+    listname = basename + "-segments.txt"
+    a3 = concatargs(fn, listname, outname, name, start, audio)
+    if dummy:
+        for label, passes in jobs:
+            for npass, args in enumerate(passes, start=1):
+                logging.info(f"{label} pass {npass}: " + " ".join(args))
+        logging.info("joining: " + " ".join(a3))
+        return 0
+    with cf.ThreadPoolExecutor(max_workers=len(jobs)) as tp:
+        rv = list(tp.map(lambda j: runpasses(*j, progress), jobs))
+    rv = next((r for r in rv if r), 0)
+    if not rv:
+        with open(listname, "w") as lf:
+            for part in junk[::2]:
+                path = os.path.abspath(part).replace("'", "'\\''")
+                lf.write(f"file '{path}'\n")
+        length = segments[-1][1] - segments[0][0]
+        rv = runpass(f"joining '{outname}'", a3, progress, length)
+    for path in junk + [listname]:
+        if os.path.exists(path):
+            os.remove(path)
+    return rv
+
+
+def quality(distorted, reference, start=0.0, length=None, metric="ssim", vf=None):
+    """
+    Compare an encoded video with (a part of) its source.
+
+    This uses ffmpeg's ssim or psnr filter.
+
+    Arguments:
+        distorted: Name of the encoded video.
+        reference: Name of the source video.
+        start: Position in the source in seconds where the encoded part starts.
+        length: Optional length of the encoded part in seconds.
+        metric: “ssim” or “psnr”.
+        vf: Optional filter that was applied to the source when encoding.
+
+    Returns:
+        The SSIM (between 0 and 1) or PSNR (in dB) averaged over all frames,
+        or None if it cannot be determined.
+    """
+    args = ["ffmpeg", "-hide_banner", "-nostats", "-i", distorted]
+    args += ["-ss", f"{start:.3f}"]
+    if length:
+        args += ["-t", f"{length:.3f}"]
+    graph = f"[0:v][1:v]{metric}"
+    if vf:
+        graph = f"[1:v]{vf}[ref];[0:v][ref]{metric}"
+    args += ["-i", reference, "-lavfi", graph, "-f", "null", "-"]
+    proc = sp.run(args, text=True, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    pattern = r"All:([\d.]+)" if metric == "ssim" else r"average:([\d.]+|inf)"
+    found = re.findall(pattern, proc.stderr)
+    if proc.returncode or not found:
+        return None
+    return float(found[-1])
+
+
+def trial(fn, name, tuning, start, length, outname, metric="ssim", vf=None):
+    """
+    Encode a part of a video with the settings of the last pass of a profile,
+    and measure it.
+
+    Arguments:
+        fn: Name of the input file.
+        name: Name of the profile in PROFILES.
+        tuning: Dict of ffmpeg options and values for encoderargs.
+        start: Start of the part in seconds.
+        length: Length of the part in seconds.
+        outname: Name of the file to write the encoded part to.
+        metric: “ssim” or “psnr”.
+        vf: Optional video filter to apply.
+
+    Returns:
+        A 2-tuple of the time the encoding took in seconds and its quality.
+        Both are None if the encoding failed.
+    """
+    profile = PROFILES[name]
+    args = encoderargs(name, profile["passes"], 1, audio=False, tuning=tuning)
+    if "-pass" in args:
+        idx = args.index("-pass")
+        del args[idx : idx + 2]
+    cmd = ["ffmpeg", "-loglevel", "quiet", "-ss", f"{start:.3f}", "-i", fn]
+    cmd += ["-t", f"{length:.3f}"] + args + ["-sn", "-f", profile["format"]]
+    if vf:
+        cmd += ["-vf", vf]
+    cmd += ["-y", outname]
+    logging.debug("trial: " + " ".join(cmd))
+    begin = time.monotonic()
+    if sp.run(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL).returncode:
+        return None, None
+    elapsed = time.monotonic() - begin
+    return elapsed, quality(outname, fn, start, length, metric, vf)
+
+
+def tune(fn, name, threads, length=TUNESECONDS, maxloss=TUNELOSS):
+    """
+    Find the fastest encoder settings for a video that keep the quality.
+
+    A part from the middle of the video is encoded with the settings of the
+    last pass of a profile. Starting from the defaults, -row-mt,
+    -tile-columns, -threads and -speed are varied one at a time. A change is
+    kept when the encoding is at least TUNEGAIN faster, and its SSIM is at most
+    maxloss lower than with the defaults.
+    The result is cached per profile, resolution and number of threads, so
+    the trials are only done once.
+
+    Arguments:
+        fn: Name of the input file.
+        name: Name of the profile in PROFILES.
+        threads: Number of threads that the encoder may use.
+        length: Length of the part to encode in seconds.
+        maxloss: Largest acceptable loss of SSIM.
+
+    Returns:
+        A dict of ffmpeg options and values for encoderargs, or None if the
+        profile has no settings to tune or the trials failed.
+    """
+    profile = PROFILES[name]
+    if not profile.get("tiles"):
+        logging.warning(f"profile {name} cannot be tuned")
+        return None
+    info = probe(fn)
+    width, height = info.get("width"), info.get("height")
+    if not width or not info.get("duration"):
+        logging.warning(f"cannot tune for '{fn}'")
+        return None
+    key = f"tune:{name}:{width}x{height}:{threads}"
+    best = cache().get(key)
+    if best is not None:
+        logging.info(f"using tuned settings {best} for {width}x{height}")
+        return best
+    length = min(length, info["duration"])
+    start = (info["duration"] - length) / 2
+    last = profile[f"pass{profile['passes']}"]
+    speed = int(last[last.index("-speed") + 1])
+    tc = tile_cols(width, threads)
+    best = {"-row-mt": 1, "-tile-columns": tc, "-threads": threads, "-speed": speed}
+    candidates = {
+        "-row-mt": [0],
+        "-tile-columns": list(range(tc)),
+        "-threads": [threads // 2] if threads > 1 else [],
+        # Higher speeds are meant for real time encoding.
+        "-speed": [s for s in (speed + 1, speed + 2) if s <= 5],
+    }
+    logging.info(f"tuning {name} for {width}x{height} with {threads} threads")
+    with tempfile.TemporaryDirectory() as workdir:
+        outname = os.path.join(workdir, "trial" + profile["extension"])
+        fastest, reference = trial(fn, name, best, start, length, outname)
+        if fastest is None or reference is None:
+            logging.warning(f"tuning for '{fn}' failed")
+            return None
+        logging.info(f"{best}: {fastest:.2f} s, SSIM {reference:.4f}")
+        for option, values in candidates.items():
+            for value in values:
+                settings = dict(best, **{option: value})
+                elapsed, ssim = trial(fn, name, settings, start, length, outname)
+                if elapsed is None or ssim is None:
+                    continue
+                logging.info(f"{settings}: {elapsed:.2f} s, SSIM {ssim:.4f}")
+                faster = elapsed < (1 - TUNEGAIN) * fastest
+                if faster and ssim >= reference - maxloss:
+                    best, fastest = settings, elapsed
+    logging.info(f"tuned settings for {width}x{height}: {best}")
+    cache().put(key, best)
+    return best
+
+
+def crfsearch(
+    fn,
+    name,
+    target,
+    metric="ssim",
+    threads=None,
+    samples=3,
+    length=TUNESECONDS,
+    tuning=None,
+    vf=None,
+):
+    """
+    Find the highest CRF for which a video reaches a target quality.
+
+    Parts spread over the video are encoded concurrently in constant quality
+    mode (“-b:v 0”) with the settings of the last pass of a profile, and
+    compared with the source. A binary search over CRFRANGE finds the highest
+    CRF where the average score of the parts is at least the target.
+    The result is cached for the file and the parameters.
+
+    Arguments:
+        fn: Name of the input file.
+        name: Name of the profile in PROFILES.
+        target: Lowest acceptable score.
+        metric: “ssim” or “psnr”.
+        threads: Number of threads for all parts together. Defaults to the
+            number of CPUs.
+        samples: Number of parts to encode.
+        length: Length of each part in seconds.
+        tuning: Optional dict of tuned settings from tune.
+        vf: Optional video filter to apply, like cropping.
+
+    Returns:
+        A dict of ffmpeg options and values for encoderargs, or None if the
+        profile does not use a CRF or the parts could not be encoded.
+    """
+    profile = PROFILES[name]
+    if "-crf" not in profile["video"]:
+        logging.warning(f"profile {name} does not use a CRF")
+        return None
+    info = probe(fn)
+    if not info.get("duration"):
+        logging.warning(f"cannot search a CRF for '{fn}'")
+        return None
+    st = os.stat(fn)
+    key = f"crf:{name}:{metric}:{target}:{samples}:{length}:{vf}:"
+    key += f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+    best = cache().get(key)
+    if best is not None:
+        logging.info(f"using CRF {best['-crf']} for '{fn}'")
+        return best
+    length = min(length, info["duration"] / samples)
+    starts = [
+        info["duration"] * (k + 0.5) / samples - length / 2 for k in range(samples)
+    ]
+    threads = max(1, (threads or os.cpu_count()) // samples)
+    base = dict(tuning or {}, **{"-threads": threads, "-b:v": 0})
+    logging.info(f"searching the CRF for {metric} {target} of '{fn}'")
+
+    def score(crf, workdir):
+        settings = dict(base, **{"-crf": crf})
+        outnames = [
+            os.path.join(workdir, f"part{k}{profile['extension']}")
+            for k in range(samples)
+        ]
+        with cf.ThreadPoolExecutor(max_workers=samples) as tp:
+            results = tp.map(
+                lambda k: trial(
+                    fn, name, settings, starts[k], length, outnames[k], metric, vf
+                ),
+                range(samples),
+            )
+            values = [q for _, q in results]
+        if None in values:
+            return None
+        rv = sum(values) / len(values)
+        logging.info(f"CRF {crf}: {metric} {rv:.4f}")
+        return rv
+
+    low, high = CRFRANGE
+    crf = None
+    with tempfile.TemporaryDirectory() as workdir:
+        while low <= high:
+            mid = (low + high) // 2
+            value = score(mid, workdir)
+            if value is None:
+                logging.warning(f"searching the CRF for '{fn}' failed")
+                return None
+            if value >= target:
+                crf, low = mid, mid + 1
+            else:
+                high = mid - 1
+    if crf is None:
+        crf = CRFRANGE[0]
+        logging.warning(f"'{fn}' does not reach {metric} {target}; using CRF {crf}")
+    logging.info(f"using CRF {crf} for '{fn}'")
+    best = {"-crf": crf, "-b:v": 0}
+    cache().put(key, best)
+    return best